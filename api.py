@@ -1,117 +1,926 @@
 import requests
 import logging
+import hashlib
 import json
+import random
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import repeat
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from entities import *
+from locator import CinemaPoints
+from search import NameIndex
+from jsonstream import iter_members
+from breaker import CircuitBreaker
+from metrics import METRICS, API_PAGE_SECONDS, API_PAGE_BYTES, API_SHOWS_SECONDS, SHOWS_PARSE_SECONDS
 from datetime import datetime
-from config import KINOTEATR_API_TOKEN
+from config import (KINOTEATR_API_TOKEN, SHOWS_CACHE_TTL, API_PAGE_SIZE, API_PAGE_WORKERS,
+                    API_CONNECT_TIMEOUT, API_READ_TIMEOUT, API_RETRIES, API_BACKOFF, API_POOL_SIZE,
+                    SHOWS_CACHE_MAX_SHOWS, CITY_SHOWS_CACHE_MAX_SHOWS, SNAPSHOT_MAX_AGE, STALE_RETRY_INTERVAL)
 
 KINOTEATR_API_URL = 'http://api.kino-teatr.ua'
 SHOWS_IN_CITY_ENDPOINT = ['/rest/city/', '/shows']
+# bytes of response body parsed at once
+API_CHUNK_SIZE = 64 * 1024
 
 
 class ShowsInCity:
     """
     Class that wraps API calls. To be used by higher-level Request object
     """
-    def __init__(self, city, date):
-        self.content = list()
-        self.cinemas = dict()
-        self.halls = dict()
-        self.films = dict()
-        self.shows = list()
-
-        # field are imported directly from JSON API response
+    def __init__(self, city, date, response=None):
+        """
+        :param response: already received API response (e.g. recorded one).
+        If not provided, shows are fetched from API and parsed while they are received
+        """
         try:
-            self.__dict__= API.get_shows_in_city_on_date(city, date)
+            if response is None:
+                parts = API.get_shows_in_city_on_date(city, date, builder=ScheduleBuilder())
+            else:
+                parts = ScheduleBuilder.from_response(response)
         except APIError:
             raise
-
-        # setting fields after JSON import
-        try:
-            self._objectify()
-            self._set_shows()
         except Exception:
             logging.warning('error during API response parsing')
             raise
+
+        self._set_parts(city, date, time.time(), **parts)
     
+    @classmethod
+    def from_parts(cls, city, date, fetched_at, cinemas, halls, films, show_tables, validators=None):
+        """
+        Creates ShowsInCity from already parsed data (e.g. snapshot) without calling API
+        :param validators: validators of API response the data was parsed from, see API.get_shows_in_city_on_date
+        """
+        shows_in_city = cls.__new__(cls)
+        shows_in_city._set_parts(city, date, fetched_at, cinemas, halls, films, show_tables, validators)
+        return shows_in_city
+
+    def _set_parts(self, city, date, fetched_at, cinemas, halls, films, show_tables, validators=None):
+        self.city = city
+        self.date = date
+        self.fetched_at = fetched_at
+        self.cinemas = cinemas
+        self.halls = halls
+        self.films = films
+        self.show_tables = show_tables
+        self.validators = validators
+        # True while last refresh of the schedule failed and it is served as of fetched_at, set by ShowsCache
+        self.stale = False
+        self._cinema_points = None
+        self._cinema_index = None
+        self._film_tables = None
+        self._film_index = None
+        # {(cinema_id, times): rendered shows} filled by Phrases.render_shows
+        self.rendered = dict()
+        # {times: (cinemas, {cinema_id: (start, end) rows of its show table})} for known time windows, see materialize()
+        self._materialized = dict()
+        self._index_shows()
+
+    def materialize(self, windows):
+        """
+        Precomputes cinemas and rows of shows of every cinema for known time windows (SELECT_TIME buttons),
+        so that their queries need no search. Only row bounds are kept, Show views are created when they are requested.
+        Results are shared between users and must not be modified
+        :param windows: list of (time_min, time_max) as returned by Parser.parse_time
+        """
+        materialized = dict()
+        for times in windows:
+            cinemas = self._find_cinemas_with_shows(times)
+            materialized[times] = (cinemas, {cinema.id: self._find_rows(cinema.id, times) for cinema in cinemas})
+        self._materialized = materialized
+
+    def update(self, other):
+        """
+        Applies newer schedule of the same city and date. This one is not changed, as requests may still be reading it:
+        returned ShowsInCity reuses objects and show tables that did not change, so are rendered replies,
+        indexes and materialized rows of cinemas that are not affected by the change
+        :param other: ShowsInCity parsed from newer API response
+        :return: (updated ShowsInCity, set of ids of affected cinemas)
+        """
+        cinemas, changed_cinemas, removed_cinemas = _merge_items(self.cinemas, other.cinemas)
+        halls, _, _ = _merge_items(self.halls, other.halls)
+        films, changed_films, removed_films = _merge_items(self.films, other.films)
+
+        affected = set(changed_cinemas)
+        show_tables = dict()
+        for cinema_id, table in other.show_tables.items():
+            old = self.show_tables.get(cinema_id)
+            if old == table:
+                show_tables[cinema_id] = old
+            else:
+                show_tables[cinema_id] = table
+                affected.add(cinema_id)
+        affected.update(cinema_id for cinema_id in self.show_tables if cinema_id not in other.show_tables)
+
+        # renamed films change replies of every cinema showing them
+        if changed_films:
+            affected.update(cinema_id for cinema_id, table in show_tables.items()
+                            if not changed_films.isdisjoint(table.film_ids))
+
+        updated = ShowsInCity.from_parts(self.city, self.date, other.fetched_at, cinemas, halls, films, show_tables,
+                                         getattr(other, 'validators', None))
+        if not changed_cinemas and not removed_cinemas:
+            updated._cinema_points = self._cinema_points
+            updated._cinema_index = self._cinema_index
+        if not changed_films and not removed_films:
+            updated._film_index = self._film_index
+        if not affected:
+            updated._film_tables = self._film_tables
+
+        # copied at once, handlers keep adding replies to the old dict
+        rendered = self.rendered.copy()
+        updated.rendered = {key: reply for key, reply in rendered.items() if key[0] not in affected}
+        updated._materialized = self._materialized
+        updated._rematerialize(affected)
+        return updated, affected
+
     def get_cinemas_with_shows(self, times):
         """
         Returns cinemas (objects) received from API that 1) have shows at given date (self.date) and between given times
+        Cinemas are sorted by name
         """
-        # filter sessions based on time_min and time_max
-        filtered_shows = [show for show in self.shows if times[0] <= show.time <= times[1]]
+        materialized = self._materialized.get(times)
+        if materialized is not None:
+            return materialized[0]
+        return self._find_cinemas_with_shows(times)
 
-        # get hall_id from sessions and then cinema name from hall_id
-        cinemas = {self.cinemas[self.halls[show.hall_id].cinema_id] for show in filtered_shows}
+    def get_shows(self, cinema, times):
+        """
+        Returns shows (objects) received from API that 1) occur in a given cinema 2) occur between given times
+        Shows are sorted by time
+        """
+        materialized = self._materialized.get(times)
+        if materialized is not None:
+            rows = materialized[1].get(cinema.id)
+            return self.show_tables[cinema.id].get_shows(self, *rows) if rows else []
+        return self._find_shows(cinema, times)
 
-        return list(cinemas)
+    def get_films_with_shows(self, times):
+        """
+        Returns set of ids of films that have shows between given times in any cinema
+        """
+        time_min, time_max = time_to_minute(times[0]), time_to_minute(times[1])
+
+        film_ids = set()
+        for film_id, table in self.film_tables.items():
+            index = bisect_left(table.minutes, time_min)
+            if index < len(table) and table.minutes[index] <= time_max:
+                film_ids.add(film_id)
+        return film_ids
 
-    def get_shows(self, cinema, times):    
+    def get_film_shows(self, film, times):
         """
-        Returns shows (objects) received from API that 1) occur in a given cinema 2) occur between given times
-        """ 
-        shows = [show for show in self.shows if times[0] <= show.time <= times[1] and show.cinema_name == cinema.name]
-        return shows
-    
-    def _objectify(self):
+        Returns shows of film between given times in all cinemas as list of (cinema, shows sorted by time).
+        Cinemas are sorted by their first show. Shows are taken from film's table of film_tables, so the query
+        costs the same as get_shows of a single cinema
+        """
+        table = self.film_tables.get(film.id)
+        if not table:
+            return []
+
+        start = bisect_left(table.minutes, time_to_minute(times[0]))
+        end = bisect_right(table.minutes, time_to_minute(times[1]))
+        shows_by_cinema = OrderedDict()
+        for show in table.get_shows(self, start, end):
+            shows_by_cinema.setdefault(self.halls[show.hall_id].cinema_id, []).append(show)
+        return [(self.cinemas[cinema_id], shows) for cinema_id, shows in shows_by_cinema.items()]
+
+    @property
+    def film_tables(self):
+        """
+        Inverted index of shows by film: {film_id: ShowTable of film's shows in all cinemas}. Built on first use
+        """
+        if self._film_tables is None:
+            rows = dict()
+            for table in self.show_tables.values():
+                for row in zip(table.minutes, table.ids, table.film_ids, table.hall_ids):
+                    rows.setdefault(row[2], []).append(row)
+            self._film_tables = {film_id: ShowTable(film_rows) for film_id, film_rows in rows.items()}
+        return self._film_tables
+
+    @property
+    def film_index(self):
+        """
+        Search index of titles of all films for Parser. Built on first use
+        """
+        if self._film_index is None:
+            self._film_index = NameIndex((film.id, film.title) for film in self.films.values())
+        return self._film_index
+
+    @property
+    def cinema_points(self):
+        """
+        Coordinates of all cinemas prepared for Locator. Built on first use
+        """
+        if self._cinema_points is None:
+            self._cinema_points = CinemaPoints(self.cinemas.values())
+        return self._cinema_points
+
+    @property
+    def cinema_index(self):
         """
-        Transforms raw dict fields into dicts of objects
+        Search index of names of all cinemas for Parser. Built on first use
         """
-        # {id: cinema}
-        self.cinemas = {item["id"]: Cinema(item["id"], item["name"], item["latitude"], item["longitude"]) for item in self.cinemas}
+        if self._cinema_index is None:
+            self._cinema_index = NameIndex((cinema.id, cinema.name) for cinema in self.cinemas.values())
+        return self._cinema_index
 
-        # {id: hall}
-        self.halls = {item["id"]: Hall(item["id"], item["cinema_id"]) for item in self.halls}
+    def _rematerialize(self, cinema_ids):
+        """
+        Recomputes materialized windows for given cinemas only
+        """
+        materialized = dict()
+        for times, (_, rows) in self._materialized.items():
+            cinemas = self._find_cinemas_with_shows(times)
+            rows = {cinema_id: cinema_rows for cinema_id, cinema_rows in rows.items() if cinema_id not in cinema_ids}
+            for cinema in cinemas:
+                if cinema.id in cinema_ids:
+                    rows[cinema.id] = self._find_rows(cinema.id, times)
+            materialized[times] = (cinemas, rows)
+        self._materialized = materialized
+
+    def _find_cinemas_with_shows(self, times):
+        time_min, time_max = time_to_minute(times[0]), time_to_minute(times[1])
+
+        cinemas = list()
+        for cinema_id in self._cinema_ids_by_name:
+            minutes = self.show_tables[cinema_id].minutes
+
+            # first/last show of the cinema are outside of the given times
+            if minutes[-1] < time_min or minutes[0] > time_max:
+                continue
+
+            # first show at or after time_min should also be before time_max
+            index = bisect_left(minutes, time_min)
+            if index < len(minutes) and minutes[index] <= time_max:
+                cinemas.append(self.cinemas[cinema_id])
 
-        # {id: film}
-        self.films = {item["id"]: Film(item["id"], item["title"]) for item in self.films}
+        return cinemas
 
-        # [shows]
-        self.shows = [Show(item["id"], item["film_id"], item["hall_id"], datetime.strptime(times["time"], '%H:%M:%S')) for item in self.content for times in item["times"]]
+    def _find_shows(self, cinema, times):
+        table = self.show_tables.get(cinema.id)
+        if not table:
+            return []
+        return table.get_shows(self, *self._find_rows(cinema.id, times))
+
+    def _find_rows(self, cinema_id, times):
+        """
+        :return: (start, end) rows of cinema's show table between given times
+        """
+        minutes = self.show_tables[cinema_id].minutes
+        return bisect_left(minutes, time_to_minute(times[0])), bisect_right(minutes, time_to_minute(times[1]))
     
+    def _index_shows(self):
+        """
+        Builds list of ids of cinemas with shows sorted by cinema name
+        """
+        self._cinema_ids_by_name = sorted(self.show_tables, key=lambda cinema_id: self.cinemas[cinema_id].name)
+
+
+def _merge_items(items, new_items):
+    """
+    Merges {id: entity} dicts: entries of new_items that are equal to ones in items are replaced by the old objects
+    :return: (merged dict, set of ids of changed or added entries, list of ids of entries absent in new_items)
+    """
+    merged = dict()
+    changed = set()
+    for item_id, item in new_items.items():
+        old = items.get(item_id)
+        if old is not None and all(getattr(old, field) == getattr(item, field) for field in item.__slots__):
+            merged[item_id] = old
+        else:
+            merged[item_id] = item
+            changed.add(item_id)
+    return merged, changed, [item_id for item_id in items if item_id not in new_items]
+
+
+class ScheduleBuilder:
+    """
+    Builds parts of ShowsInCity (see ShowsInCity.from_parts) directly from items of API response as they are parsed,
+    so the response itself is never held in memory. Shows are kept in compact per-hall columns until result().
+    Items of several pages can be added concurrently, repeated ones (e.g. cinemas of every page) are skipped
+    """
+    COLLECTIONS = ('content', 'cinemas', 'halls', 'films')
+
+    def __init__(self):
+        self.cinemas = dict()
+        self.halls = dict()
+        self.films = dict()
+        # {hall_id: (minutes, show ids, film ids)}
+        self._hall_columns = dict()
+        self._show_ids = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_response(cls, response):
+        """
+        :param response: whole API response (e.g. recorded one)
+        :return: parts of ShowsInCity
+        """
+        builder = cls()
+        for collection in cls.COLLECTIONS:
+            for item in response.get(collection, ()):
+                builder.add(collection, item)
+        return builder.result(response.get('validators'))
+
+    def add(self, collection, item):
+        with self._lock:
+            if collection == 'content':
+                self._add_show(item)
+            elif item["id"] in getattr(self, collection):
+                return
+            elif collection == 'cinemas':
+                self.cinemas[item["id"]] = Cinema(item["id"], item["name"], item["latitude"], item["longitude"])
+            elif collection == 'halls':
+                self.halls[item["id"]] = Hall(item["id"], item["cinema_id"])
+            elif collection == 'films':
+                self.films[item["id"]] = Film(item["id"], item["title"])
 
-    def _set_shows(self):
+    @SHOWS_PARSE_SECONDS.time()
+    def result(self, validators=None):
         """
-        Assigning film titles and cinema names to shows for convenience
+        :return: parts of ShowsInCity with per-cinema ShowTables
         """
-        for show in self.shows:
-            # assign film_title
-            show.film_title = self.films[show.film_id].title
+        # {cinema_id: [(minutes, show ids, film ids, hall_id)]}
+        halls_by_cinema = dict()
+        for hall_id, columns in self._hall_columns.items():
+            halls_by_cinema.setdefault(self.halls[hall_id].cinema_id, []).append(columns + (repeat(hall_id),))
+
+        show_tables = {cinema_id: ShowTable(row for columns in halls for row in zip(*columns))
+                       for cinema_id, halls in halls_by_cinema.items()}
+        return {'cinemas': self.cinemas,
+                'halls': self.halls,
+                'films': self.films,
+                'show_tables': show_tables,
+                'validators': validators}
+
+    def _add_show(self, item):
+        if item["id"] in self._show_ids:
+            return
+        self._show_ids.add(item["id"])
+
+        columns = self._hall_columns.get(item["hall_id"])
+        if columns is None:
+            columns = self._hall_columns[item["hall_id"]] = (array('H'), array('l'), array('l'))
+        minutes, show_ids, film_ids = columns
+        for times in item["times"]:
+            minutes.append(parse_minute(times["time"]))
+            show_ids.append(item["id"])
+            film_ids.append(item["film_id"])
+
+
+class ResponseBuilder:
+    """
+    Merges items of all pages into one response, e.g. to record it. Same interface as ScheduleBuilder
+    """
+    COLLECTIONS = ScheduleBuilder.COLLECTIONS
+
+    def __init__(self):
+        self.response = {collection: [] for collection in self.COLLECTIONS}
+        # ids already merged for every collection
+        self._seen = {collection: set() for collection in self.COLLECTIONS}
+        self._lock = threading.Lock()
 
-            # assing cinema_name
-            show.cinema_name = self.cinemas[self.halls[show.hall_id].cinema_id].name
+    def add(self, collection, item):
+        with self._lock:
+            if item["id"] not in self._seen[collection]:
+                self._seen[collection].add(item["id"])
+                self.response[collection].append(item)
+
+    def result(self, validators=None):
+        return dict(self.response, validators=validators)
 
 
 class APIError(Exception):
     pass
 
+
+# fetches of shows fail fast while kino-teatr API keeps failing
+API_BREAKER = CircuitBreaker('kino-teatr', error=APIError)
+
+
 class API:
     """
     Low-level class that communicates with API. To be used by generic classes that wrap different endpoints responses.
     Has only class method. Variables are taken from config.py (TOKEN, URL)/
     """
+    _session = None
+    _session_lock = threading.Lock()
+
     @classmethod
-    def get_shows_in_city_on_date(self, city=1, date=str(datetime.now().date()), size=500):
+    @API_SHOWS_SECONDS.time()
+    @API_BREAKER.protect
+    def get_shows_in_city_on_date(self, city=1, date=str(datetime.now().date()), size=API_PAGE_SIZE, validators=None,
+                                  builder=None):
         """
-        Params for get request are hard-coded. Should be re-checked
-        :return: API response
+        Fetches first page to find out number of pages, then fetches the rest concurrently
+        (at most API_PAGE_WORKERS at a time). Pages are parsed while they are received and their items are added to builder
+        :param validators: validators returned previous time. Pages are requested conditionally (ETag/Last-Modified)
+        and compared by content hash when server does not support it
+        :param builder: ScheduleBuilder to get ShowsInCity parts, ResponseBuilder (default) to get the response itself
+        :return: builder.result() with validators of pages or None if validators were given and no page has changed
         """
         params = {'size': size,
-                  'page': 0,
                   'detalization': 'FULL',
                   'apiKey': KINOTEATR_API_TOKEN,
                   'date': date}
         
         # URL is dynamic based on CITY
         url = KINOTEATR_API_URL + str(city).join(SHOWS_IN_CITY_ENDPOINT)
+        validators = validators or []
+        builder = builder or ResponseBuilder()
+
+        def get_page(page, conditional=True):
+            validator = validators[page] if conditional and page < len(validators) else None
+            return self._get_page(url, params, page, builder, validator)
+
+        first, validator, modified = get_page(0)
+        # not modified first page is not received, so number of pages is the same as previous time
+        pages = self._count_pages(first, size) if first is not None else len(validators)
+        pages_validators = [validator] + [None] * (pages - 1)
+        # pages that were not modified and not received
+        missing = list() if first is not None else [0]
+
+        if pages > 1:
+            with ThreadPoolExecutor(max_workers=min(API_PAGE_WORKERS, pages - 1)) as executor:
+                futures = {executor.submit(get_page, page): page for page in range(1, pages)}
+                for future in as_completed(futures):
+                    page = futures[future]
+                    members, pages_validators[page], page_modified = future.result()
+                    modified = modified or page_modified
+                    if members is None:
+                        missing.append(page)
 
-        r = requests.get(url, params=params)
-        if not r.status_code == 200:
-            logging.warning("API response status code '{}' endpoint '{}'".format(str(r.status_code), url))
+        if validators and not modified and pages == len(validators):
+            return None
+
+        # something has changed, so not modified pages are needed too
+        for page in missing:
+            _, pages_validators[page], _ = get_page(page, conditional=False)
+
+        return builder.result(pages_validators)
+
+    @classmethod
+    def _get_page(self, url, params, page, builder, validator=None):
+        """
+        GET with timeouts. Retries connection errors, timeouts and 5xx responses with jittered exponential backoff
+        :param builder: receives items of builder.COLLECTIONS while body is parsed. Items of interrupted and retried
+        response are added again, so builder must skip repeated ones
+        :param validator: validator of the page returned previous time to request it conditionally
+        :return: (other members of page JSON (e.g. 'totalPages') or None if server replied 304 Not Modified,
+        validator of the page, whether it was modified)
+        """
+        headers = dict()
+        if validator and validator.get('etag'):
+            headers['If-None-Match'] = validator['etag']
+        if validator and validator.get('last_modified'):
+            headers['If-Modified-Since'] = validator['last_modified']
+
+        started = time.perf_counter()
+        for attempt in range(API_RETRIES + 1):
+            if attempt:
+                time.sleep(random.uniform(0, API_BACKOFF * 2 ** (attempt - 1)))
+            try:
+                with self._get_session().get(url, params=dict(params, page=page), headers=headers, stream=True,
+                                             timeout=(API_CONNECT_TIMEOUT, API_READ_TIMEOUT)) as r:
+                    if r.status_code >= 500:
+                        logging.warning("API response status code '{}' endpoint '{}' page '{}' attempt '{}'".format(str(r.status_code), url, page, attempt + 1))
+                        continue
+                    if r.status_code == 304 and validator:
+                        result = (None, validator, False)
+                    elif r.status_code == 200:
+                        result = self._read_page(r, builder, validator)
+                    else:
+                        logging.warning("API response status code '{}' endpoint '{}' page '{}'".format(str(r.status_code), url, page))
+                        raise APIError
+                    break
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                logging.warning("API request error '{}' endpoint '{}' page '{}' attempt '{}'".format(e.__class__.__name__, url, page, attempt + 1))
+        else:
+            logging.warning("API gave up endpoint '{}' page '{}' after '{}' retries".format(url, page, API_RETRIES))
             raise APIError
 
-        return r.json()
+        duration = time.perf_counter() - started
+        API_PAGE_SECONDS.observe(duration)
+        logging.info("API endpoint '{}' page '{}' took {:.3f}s with '{}' retries".format(url, page, duration, attempt))
+        return result
+
+    @classmethod
+    def _read_page(self, r, builder, validator):
+        """
+        Parses body of the page as it is received, hashing it on the way
+        """
+        digest = hashlib.sha1()
+        size = 0
+
+        def chunks():
+            nonlocal size
+            for chunk in r.iter_content(API_CHUNK_SIZE):
+                digest.update(chunk)
+                size += len(chunk)
+                yield chunk
+
+        members = dict()
+        for name, value in iter_members(chunks(), builder.COLLECTIONS):
+            if name in builder.COLLECTIONS:
+                builder.add(name, value)
+            else:
+                members[name] = value
+        API_PAGE_BYTES.observe(size)
+
+        new_validator = {'etag': r.headers.get('ETag'),
+                         'last_modified': r.headers.get('Last-Modified'),
+                         'hash': digest.hexdigest()}
+        modified = not validator or validator.get('hash') != new_validator['hash']
+        return members, new_validator, modified
+
+    @classmethod
+    def _get_session(self):
+        """
+        Session is shared by all API calls so connections are kept alive and reused
+        """
+        with self._session_lock:
+            if self._session is None:
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=API_POOL_SIZE)
+                self._session = requests.Session()
+                self._session.mount('http://', adapter)
+                self._session.mount('https://', adapter)
+            return self._session
+
+    @classmethod
+    def _count_pages(self, response, size):
+        if response.get('totalPages') is not None:
+            return int(response['totalPages'])
+        if response.get('totalElements') is not None:
+            return -(-int(response['totalElements']) // size)
+        return 1
+
+
+class _Flight:
+    """
+    Single upstream fetch that concurrent cache misses for the same key wait on
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.event.wait()
+        if self.error:
+            raise self.error
+        return self.result
+
+
+class ShowsCache:
+    """
+    Process-wide cache of ShowsInCity objects keyed by (city, date).
+    Entries expire after ttl seconds. Concurrent misses for the same key are coalesced into one API call.
+    If snapshots (SnapshotStore) are given, fetched schedules are saved there and misses are served from them first.
+    Cached objects are shared between all Requests and must be treated as read-only, refresh() replaces them with updated
+    copies (only their fetched_at and stale flag are set in place).
+    When shows of all cached schedules exceed max_shows, least recently used schedules are evicted.
+    Expired schedules are served as they are while they are revalidated in background (stale-while-revalidate),
+    so requests do not wait for API. Schedule whose refresh failed is marked stale until a refresh succeeds.
+    """
+    def __init__(self, ttl=SHOWS_CACHE_TTL, snapshots=None, windows=(), max_shows=SHOWS_CACHE_MAX_SHOWS, readonly=False,
+                 stale_after=None, max_stale=SNAPSHOT_MAX_AGE, fetcher=None):
+        """
+        :param windows: time windows materialized in every loaded ShowsInCity, see ShowsInCity.materialize
+        :param max_shows: memory budget in shows (rows of show tables) of all cached schedules
+        :param readonly: stale snapshots are not refreshed from API - another process keeps them up to date
+        and they are checked again after ttl
+        :param stale_after: age in seconds after which snapshot is marked stale in readonly cache (ttl by default)
+        :param max_stale: seconds since fetch after which expired schedule is not served anymore
+        :param fetcher: function of (city, date) that has another process fetch a schedule missing in snapshots
+        and waits for it. Readonly cache never calls API itself, without fetcher its misses raise APIError
+        """
+        self.ttl = ttl
+        self.snapshots = snapshots
+        self.windows = windows
+        self.max_shows = max_shows
+        self.readonly = readonly
+        self.stale_after = stale_after or ttl
+        self.max_stale = max_stale
+        self.fetcher = fetcher
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # {(city, date): (expires_at, shows_in_city, shows)} ordered from least to most recently used
+        self._entries = OrderedDict()
+        # {(city, date): _Flight}
+        self._flights = dict()
+        # keys revalidated in background
+        self._revalidating = set()
+        self._lock = threading.Lock()
+
+    def get(self, city, date):
+        """
+        Returns cached ShowsInCity for city and date, loading it from snapshot or API if absent.
+        Expired one is returned at once and revalidated in background
+        """
+        key = (city, date)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                now = time.monotonic()
+                if entry[0] <= now:
+                    self.stale_hits += 1
+                    # if revalidation fails, it is tried again by a request after STALE_RETRY_INTERVAL
+                    self._entries[key] = (now + STALE_RETRY_INTERVAL,) + entry[1:]
+                    self._revalidate_in_background(city, date)
+                return entry[1]
+
+            self.misses += 1
+            flight = self._flights.get(key)
+            if flight:
+                leader = False
+            else:
+                leader = True
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            return flight.wait()
+
+        try:
+            flight.result = self._load(city, date)
+        except Exception as e:
+            flight.error = e
+            raise
+        else:
+            return flight.result
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.event.set()
+
+    def refresh(self, city, date, ttl=None):
+        """
+        Fetches ShowsInCity from API and replaces cached one.
+        Cached one (or snapshot if nothing is cached) is requested conditionally: if API response has not changed
+        it is only kept for another ttl, otherwise it is replaced by its updated copy (see ShowsInCity.update)
+        :param ttl: seconds to keep it cached if different from self.ttl
+        """
+        with self._lock:
+            entry = self._entries.get((city, date))
+        current = entry[1] if entry else None
+        if current is None and self.snapshots:
+            # e.g. prefetch after restart: snapshot has validators of the last fetch
+            snapshot = self.snapshots.load(city, date)
+            if snapshot:
+                current = ShowsInCity.from_parts(city, date, snapshot[0], **snapshot[1])
+                current.materialize(self.windows)
+
+        if current is None or not current.validators:
+            shows_in_city = self._fetch(city, date)
+        else:
+            shows_in_city = self._fetch_changes(current)
+        shows_in_city.stale = False
+        self._put(shows_in_city, ttl or self.ttl)
+        return shows_in_city
 
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'stale_hits': self.stale_hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._entries),
+                    'shows': sum(entry[2] for entry in self._entries.values())}
+
+    def _load(self, city, date):
+        """
+        Snapshot younger than ttl is cached for the rest of ttl. Older one is served for ttl while it is refreshed
+        in background (unless cache is readonly, then it is marked stale after stale_after).
+        Without a snapshot ShowsInCity is fetched from API, by fetcher's process if cache is readonly
+        """
+        snapshot = self.snapshots.load(city, date) if self.snapshots else None
+        if not snapshot and not self.readonly:
+            return self.refresh(city, date)
+        if not snapshot:
+            if self.fetcher is None:
+                raise APIError("no shared schedule of city '{}' date '{}'".format(city, date))
+            self.fetcher(city, date)
+            snapshot = self.snapshots.load(city, date)
+            if not snapshot:
+                raise APIError("shared schedule of city '{}' date '{}' was not saved".format(city, date))
+
+        fetched_at, parts = snapshot
+        with self._lock:
+            entry = self._entries.get((city, date))
+        if entry and (entry[1].fetched_at == fetched_at or (entry[1].validators and entry[1].validators == parts['validators'])):
+            # expired entry is still the same as snapshot (e.g. shared store was not updated yet or was only touched)
+            shows_in_city = entry[1]
+            shows_in_city.fetched_at = fetched_at
+        else:
+            shows_in_city = ShowsInCity.from_parts(city, date, fetched_at, **parts)
+            shows_in_city.materialize(self.windows)
+        age = time.time() - fetched_at
+        if self.readonly:
+            shows_in_city.stale = age >= self.stale_after
+        if age < self.ttl:
+            self._put(shows_in_city, self.ttl - age)
+        else:
+            self._put(shows_in_city, self.ttl)
+            if not self.readonly:
+                with self._lock:
+                    self._revalidate_in_background(city, date)
+        return shows_in_city
+
+    def _fetch(self, city, date):
+        shows_in_city = ShowsInCity(city, date)
+        shows_in_city.materialize(self.windows)
+        if self.snapshots:
+            self.snapshots.save(shows_in_city)
+        return shows_in_city
+
+    def _fetch_changes(self, shows_in_city):
+        parts = API.get_shows_in_city_on_date(shows_in_city.city, shows_in_city.date, validators=shows_in_city.validators,
+                                              builder=ScheduleBuilder())
+        if parts is None:
+            logging.info("shows of city '{}' date '{}' not modified".format(shows_in_city.city, shows_in_city.date))
+            shows_in_city.fetched_at = time.time()
+            # stored schedule is the same, so only its time is updated
+            if self.snapshots:
+                self.snapshots.touch(shows_in_city)
+            return shows_in_city
+
+        shows_in_city, affected = shows_in_city.update(ShowsInCity.from_parts(shows_in_city.city, shows_in_city.date,
+                                                                               time.time(), **parts))
+        logging.info("shows of city '{}' date '{}' changed in {} cinemas".format(shows_in_city.city, shows_in_city.date, len(affected)))
+        if self.snapshots:
+            self.snapshots.save(shows_in_city)
+        return shows_in_city
+
+    def _revalidate_in_background(self, city, date):
+        """
+        Starts refresh (or reload from snapshot if cache is readonly) unless one is already running. Must hold self._lock
+        """
+        key = (city, date)
+        if key not in self._revalidating:
+            self._revalidating.add(key)
+            threading.Thread(target=self._revalidate, args=(city, date), daemon=True).start()
+
+    def _revalidate(self, city, date):
+        try:
+            if self.readonly:
+                self._load(city, date)
+            else:
+                self.refresh(city, date)
+        except Exception as e:
+            logging.warning("background refresh of city '{}' date '{}' failed: {!r}".format(city, date, e))
+            with self._lock:
+                entry = self._entries.get((city, date))
+            if entry and not self.readonly:
+                entry[1].stale = True
+        finally:
+            with self._lock:
+                self._revalidating.discard((city, date))
+
+    def _put(self, shows_in_city, ttl):
+        key = (shows_in_city.city, shows_in_city.date)
+        shows = sum(len(table) for table in shows_in_city.show_tables.values())
+        with self._lock:
+            self._purge_expired()
+            self._entries.pop(key, None)
+            self._entries[key] = (time.monotonic() + ttl, shows_in_city, shows)
+            self._evict()
+
+    def _purge_expired(self):
+        """
+        Drops expired schedules fetched more than max_stale seconds ago
+        """
+        now = time.monotonic()
+        oldest = time.time() - self.max_stale
+        for key in [key for key, entry in self._entries.items() if entry[0] <= now and entry[1].fetched_at < oldest]:
+            del self._entries[key]
+
+    def _evict(self):
+        """
+        Drops least recently used schedules until budget is met, the most recent one is always kept
+        """
+        shows = sum(entry[2] for entry in self._entries.values())
+        while shows > self.max_shows and len(self._entries) > 1:
+            key, entry = self._entries.popitem(last=False)
+            shows -= entry[2]
+            self.evictions += 1
+            logging.info("shows of city '{}' date '{}' evicted from cache".format(*key))
+
+
+class CityShowsCache:
+    """
+    ShowsCache sharded by city. Every city has its own entries, lock and memory budget,
+    so traffic of one city never evicts schedules of another. Shards of cities without a budget are created on first use
+    """
+    def __init__(self, budgets=CITY_SHOWS_CACHE_MAX_SHOWS, ttl=SHOWS_CACHE_TTL, snapshots=None, windows=(), readonly=False):
+        """
+        :param budgets: {city: max_shows of its shard}, SHOWS_CACHE_MAX_SHOWS for other cities
+        """
+        self.budgets = budgets
+        self.ttl = ttl
+        self.snapshots = snapshots
+        self.readonly = readonly
+        self.stale_after = None
+        self.fetcher = None
+        self._windows = windows
+        # {city: ShowsCache}
+        self._shards = dict()
+        self._lock = threading.Lock()
+
+    @property
+    def windows(self):
+        return self._windows
+
+    @windows.setter
+    def windows(self, windows):
+        with self._lock:
+            self._windows = windows
+            for shard in self._shards.values():
+                shard.windows = windows
+
+    def use_snapshots(self, snapshots):
+        """
+        Saves fetched schedules to snapshots (SnapshotStore) and serves misses from them
+        """
+        with self._lock:
+            self.snapshots = snapshots
+            for shard in self._shards.values():
+                shard.snapshots = snapshots
+
+    def use_shared_store(self, store, readonly, ttl=None, stale_after=None, fetcher=None):
+        """
+        Switches cache to schedules shared between processes (SharedScheduleStore). Shards that already exist are switched too
+        :param readonly: this process only reads the store, another one fetches schedules
+        :param ttl: seconds before cached schedules are checked in store again
+        :param stale_after: age in seconds after which schedule in store is considered not refreshed by its fetcher
+        :param fetcher: function of (city, date) that has schedule missing in store fetched by another process
+        """
+        self.use_snapshots(store)
+        with self._lock:
+            self.readonly = readonly
+            self.stale_after = stale_after
+            self.fetcher = fetcher
+            self.ttl = ttl or self.ttl
+            for shard in self._shards.values():
+                shard.readonly = readonly
+                shard.fetcher = fetcher
+                shard.ttl = self.ttl
+                shard.stale_after = stale_after or self.ttl
+
+    def shard(self, city):
+        """
+        :return: ShowsCache of the city
+        """
+        shard = self._shards.get(city)
+        if shard is None:
+            with self._lock:
+                shard = self._shards.get(city)
+                if shard is None:
+                    shard = self._shards[city] = ShowsCache(self.ttl, self.snapshots, self._windows,
+                                                            self.budgets.get(city, SHOWS_CACHE_MAX_SHOWS), self.readonly,
+                                                            self.stale_after, fetcher=self.fetcher)
+        return shard
+
+    def get(self, city, date):
+        return self.shard(city).get(city, date)
+
+    def refresh(self, city, date, ttl=None):
+        return self.shard(city).refresh(city, date, ttl)
+
+    def stats(self):
+        """
+        :return: {city: stats of its shard}
+        """
+        with self._lock:
+            shards = list(self._shards.items())
+        return {city: shard.stats() for city, shard in shards}
+
+    def total(self, stat):
+        """
+        :return: sum of stat (e.g. 'hits') over all shards
+        """
+        return sum(stats[stat] for stats in self.stats().values())
 
 
+# shared by all requests in the process, snapshots are used when the bot is run (see main.py)
+SHOWS_CACHE = CityShowsCache()
 
+METRICS.gauge('shows_cache_hits_total', 'Shows cache lookups served from cache', lambda: SHOWS_CACHE.total('hits'), type='counter')
+METRICS.gauge('shows_cache_stale_hits_total', 'Shows cache lookups served with expired schedule while it was revalidated',
+              lambda: SHOWS_CACHE.total('stale_hits'), type='counter')
+METRICS.gauge('shows_cache_misses_total', 'Shows cache lookups that waited for snapshot or API', lambda: SHOWS_CACHE.total('misses'), type='counter')
+METRICS.gauge('shows_cache_evictions_total', 'Schedules evicted from shows cache over city budget', lambda: SHOWS_CACHE.total('evictions'), type='counter')
+METRICS.gauge('shows_cache_entries', 'Schedules in shows cache', lambda: SHOWS_CACHE.total('entries'))
+METRICS.gauge('shows_cache_shows', 'Shows in all cached schedules', lambda: SHOWS_CACHE.total('shows'))
+METRICS.gauge('api_circuit_open', 'Whether calls to kino-teatr API fail fast (1 open, 0.5 half-open, 0 closed)',
+              lambda: {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 0.5, CircuitBreaker.OPEN: 1}[API_BREAKER.state])
+METRICS.gauge('api_circuit_rejected_total', 'Calls to kino-teatr API rejected while circuit was open',
+              lambda: API_BREAKER.rejected, type='counter')
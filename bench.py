@@ -0,0 +1,246 @@
+"""
+Offline benchmarks of the data path: parsing of shows response (already decoded one and streamed from bytes), queries (by cinema and by film), nearest cinemas search,
+cinema name parsing and rendering of replies (render_shows is measured with its cache already filled).
+
+Every stage is run against recorded (bench_fixtures/shows.json, see --record) or synthetic response
+scaled to 1x, 10x and 100x shows. Time (best of --repeat runs) and peak memory (tracemalloc) are reported
+per stage and compared against stored baseline (--baseline), regressions make the script exit with 1.
+
+    python3 bench.py --record            # save real API response as fixture (needs KINOTEATR_API_TOKEN)
+    python3 bench.py --save-baseline     # run and store results as baseline
+    python3 bench.py                     # run and compare with baseline
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+from collections import namedtuple
+from datetime import datetime
+from api import ShowsInCity, ScheduleBuilder, API, API_CHUNK_SIZE
+from jsonstream import iter_members
+from locator import Locator
+from parser import Parser, ParsingError
+from phrases import Phrases
+
+FIXTURE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_fixtures', 'shows.json')
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+
+SCALES = (1, 10, 100)
+DATE = '2018-11-30'
+
+# SELECT_TIME windows
+WINDOWS = [tuple(datetime.strptime(time, '%H:%M') for time in window.split('-'))
+           for window in ('00:00-15:59', '13:00-23:59', '00:00-23:59', '17:00-23:59')]
+
+# same shape as telebot's Message for Parser.parse_cinema
+Message = namedtuple('Message', ['text'])
+
+
+def synthesize_payload(cinemas=40, halls_per_cinema=4, films=60, items=700, seed=0):
+    """
+    Response of /rest/city/{id}/shows with Kyiv-like amount of cinemas and shows
+    """
+    rnd = random.Random(seed)
+    words = ['Кінопалац', 'Multiplex', 'Планета Кіно', 'Жовтень', 'Київська Русь', 'Oskar', 'Cinema City', 'Лейпциг']
+    payload = {'cinemas': [{'id': cinema_id,
+                            'name': '{} {}'.format(rnd.choice(words), cinema_id),
+                            'latitude': str(50.35 + rnd.random() * 0.2),
+                            'longitude': str(30.35 + rnd.random() * 0.35)}
+                           for cinema_id in range(1, cinemas + 1)],
+               'films': [{'id': film_id, 'title': 'Фільм {}'.format(film_id)} for film_id in range(1, films + 1)]}
+    payload['halls'] = [{'id': cinema['id'] * 100 + hall, 'cinema_id': cinema['id']}
+                        for cinema in payload['cinemas'] for hall in range(halls_per_cinema)]
+    payload['content'] = [{'id': item_id,
+                           'film_id': rnd.randint(1, films),
+                           'hall_id': rnd.choice(payload['halls'])['id'],
+                           'times': [{'time': '{:02d}:{:02d}:00'.format(rnd.randint(9, 23), rnd.choice((0, 10, 20, 30, 40, 50)))}
+                                     for _ in range(rnd.randint(1, 6))]}
+                          for item_id in range(1, items + 1)]
+    return payload
+
+
+def scale_payload(payload, scale, seed=0):
+    """
+    Repeats shows of payload scale times with new ids and shifted start times
+    """
+    rnd = random.Random(seed)
+    step = max(item['id'] for item in payload['content']) + 1
+    content = list(payload['content'])
+    for copy in range(1, scale):
+        for item in payload['content']:
+            times = []
+            for times_item in item['times']:
+                minutes = (int(times_item['time'][:2]) * 60 + int(times_item['time'][3:5]) + rnd.randint(-90, 90)) % (24 * 60)
+                times.append({'time': '{:02d}:{:02d}:00'.format(minutes // 60, minutes % 60)})
+            content.append(dict(item, id=item['id'] + copy * step, times=times))
+    return dict(payload, content=content)
+
+
+def load_payload():
+    if os.path.exists(FIXTURE_PATH):
+        with open(FIXTURE_PATH, encoding='utf-8') as fixture:
+            return json.load(fixture)
+    return synthesize_payload()
+
+
+def record_payload(city=1, date=None):
+    payload = API.get_shows_in_city_on_date(city, date or str(datetime.now().date()))
+    os.makedirs(os.path.dirname(FIXTURE_PATH), exist_ok=True)
+    with open(FIXTURE_PATH, 'w', encoding='utf-8') as fixture:
+        json.dump(payload, fixture, ensure_ascii=False)
+
+
+def get_stages(payload):
+    """
+    :return: list of (name, setup, run). setup() prepares argument for run(argument) outside of measurement
+    """
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+
+    def stream_parse(body):
+        builder = ScheduleBuilder()
+        chunks = (body[start:start + API_CHUNK_SIZE] for start in range(0, len(body), API_CHUNK_SIZE))
+        for name, value in iter_members(chunks, builder.COLLECTIONS):
+            if name in builder.COLLECTIONS:
+                builder.add(name, value)
+        return builder.result()
+
+    shows_in_city = ShowsInCity(1, DATE, dict(payload))
+    cinemas = [shows_in_city.get_cinemas_with_shows(window) for window in WINDOWS]
+    shows = [shows_in_city.get_shows(cinema, window) for window in WINDOWS for cinema in shows_in_city.cinemas.values()]
+    rnd = random.Random(0)
+    locations = [(50.35 + rnd.random() * 0.2, 30.35 + rnd.random() * 0.35) for _ in range(100)]
+    messages = [Message(cinema.name.lower()[-6:]) for cinema in cinemas[2]] + [Message('/{}'.format(index)) for index in range(1, 11)]
+    mapping = {index + 1: cinema for index, cinema in enumerate(cinemas[2])}
+
+    def parse_cinemas(messages):
+        # same call as Request.set_cinema_from_message makes
+        for message in messages:
+            try:
+                Parser.parse_cinema(message, cinemas[2], mapping, index=shows_in_city.cinema_index)
+            except ParsingError:
+                pass
+
+    def without_film_tables():
+        shows_in_city._film_tables = None
+        return shows_in_city
+
+    def without_cinema_index():
+        shows_in_city._cinema_index = None
+        return shows_in_city
+
+    return [('parse', lambda: payload, ScheduleBuilder.from_response),
+            ('stream_parse', lambda: body, stream_parse),
+            ('_index_shows', lambda: shows_in_city, lambda shows_in_city: shows_in_city._index_shows()),
+            ('get_cinemas_with_shows', lambda: shows_in_city,
+             lambda shows_in_city: [shows_in_city.get_cinemas_with_shows(window) for window in WINDOWS]),
+            ('get_shows', lambda: shows_in_city,
+             lambda shows_in_city: [shows_in_city.get_shows(cinema, window)
+                                    for window in WINDOWS for cinema in shows_in_city.cinemas.values()]),
+            ('film_tables', without_film_tables, lambda shows_in_city: shows_in_city.film_tables),
+            ('get_film_shows', lambda: shows_in_city,
+             lambda shows_in_city: [shows_in_city.get_film_shows(film, window)
+                                    for window in WINDOWS for film in shows_in_city.films.values()]),
+            ('get_verified_closest', lambda: locations,
+             lambda locations: [Locator.get_verified_closest(latitude, longitude, cinemas[2], points=shows_in_city.cinema_points)
+                                for latitude, longitude in locations]),
+            ('cinema_index', without_cinema_index, lambda shows_in_city: shows_in_city.cinema_index),
+            ('parse_cinema', lambda: messages, parse_cinemas),
+            ('string_cinemas', lambda: cinemas, lambda cinemas: [Phrases.string_cinemas(items) for items in cinemas]),
+            ('string_shows', lambda: shows, lambda shows: [Phrases.string_shows(items) for items in shows]),
+            ('render_shows', lambda: shows_in_city,
+             lambda shows_in_city: [Phrases.render_shows(shows_in_city, cinema, window)
+                                    for window in WINDOWS for cinema in shows_in_city.cinemas.values()])]
+
+
+def measure(setup, run, repeat):
+    """
+    :return: best time in seconds and peak memory in bytes allocated during run
+    """
+    times = []
+    for _ in range(repeat):
+        argument = setup()
+        started = time.perf_counter()
+        run(argument)
+        times.append(time.perf_counter() - started)
+
+    argument = setup()
+    tracemalloc.start()
+    run(argument)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return min(times), peak
+
+
+def run_benchmarks(scales=SCALES, repeat=5):
+    """
+    :return: {scale: {stage: {'time': seconds, 'peak': bytes}}}
+    """
+    payload = load_payload()
+    results = dict()
+    for scale in scales:
+        scaled = scale_payload(payload, scale)
+        shows = sum(len(item['times']) for item in scaled['content'])
+        print('{}x: {} shows'.format(scale, shows))
+        results[str(scale)] = dict()
+        for name, setup, run in get_stages(scaled):
+            seconds, peak = measure(setup, run, repeat if scale < 100 else max(repeat // 2, 1))
+            results[str(scale)][name] = {'time': seconds, 'peak': peak}
+            print('  {:<24} {:>10.3f} ms {:>10.1f} KiB'.format(name, seconds * 1000, peak / 1024))
+    return results
+
+
+def find_regressions(results, baseline, tolerance):
+    """
+    :return: list of descriptions of stages that are slower or use more memory than baseline by more than tolerance
+    """
+    regressions = []
+    for scale, stages in results.items():
+        for name, result in stages.items():
+            expected = baseline.get(scale, {}).get(name)
+            if not expected:
+                continue
+            for metric in ('time', 'peak'):
+                if expected[metric] and result[metric] > expected[metric] * (1 + tolerance):
+                    regressions.append('{}x {} {}: {:.4g} -> {:.4g} (+{:.0%})'.format(
+                        scale, name, metric, expected[metric], result[metric], result[metric] / expected[metric] - 1))
+    return regressions
+
+
+def main():
+    arguments = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arguments.add_argument('--record', action='store_true', help='save API response to ' + FIXTURE_PATH + ' and exit')
+    arguments.add_argument('--scales', type=int, nargs='+', default=SCALES)
+    arguments.add_argument('--repeat', type=int, default=5)
+    arguments.add_argument('--baseline', default=BASELINE_PATH)
+    arguments.add_argument('--save-baseline', action='store_true')
+    arguments.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown, 0.25 = 25%%')
+    arguments = arguments.parse_args()
+
+    if arguments.record:
+        record_payload()
+        return 0
+
+    results = run_benchmarks(arguments.scales, arguments.repeat)
+
+    if arguments.save_baseline:
+        with open(arguments.baseline, 'w') as baseline:
+            json.dump(results, baseline, indent=2)
+        return 0
+
+    if not os.path.exists(arguments.baseline):
+        print('no baseline at {}, run with --save-baseline'.format(arguments.baseline))
+        return 0
+
+    with open(arguments.baseline) as baseline:
+        regressions = find_regressions(results, json.load(baseline), arguments.tolerance)
+    for regression in regressions:
+        print('REGRESSION ' + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
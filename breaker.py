@@ -0,0 +1,71 @@
+import functools
+import logging
+import threading
+import time
+from config import BREAKER_FAILURES, BREAKER_RESET_TIMEOUT
+
+
+class CircuitBreaker:
+    """
+    Stops calling failing upstream. After failures consecutive failed calls the circuit opens and calls fail fast
+    with error for reset_timeout seconds. Then a single probe call is let through (half-open):
+    its success closes the circuit, its failure opens it again
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, name, failures=BREAKER_FAILURES, reset_timeout=BREAKER_RESET_TIMEOUT, error=Exception):
+        """
+        :param error: exception class raised instead of calling upstream while circuit is open
+        """
+        self.name = name
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.error = error
+        self.state = self.CLOSED
+        self.rejected = 0
+
+        self._failed = 0
+        self._opened_at = 0
+        self._lock = threading.Lock()
+
+    def protect(self, function):
+        """
+        Decorator passing calls of decorated function through the circuit. Every exception counts as a failure
+        """
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            self._before_call()
+            try:
+                result = function(*args, **kwargs)
+            except Exception:
+                self._on_failure()
+                raise
+            self._on_success()
+            return result
+        return wrapper
+
+    def _before_call(self):
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                logging.warning("circuit '{}' is half-open, probing upstream".format(self.name))
+                self.state = self.HALF_OPEN
+                return
+            if self.state != self.CLOSED:
+                # open or probe is in flight
+                self.rejected += 1
+                raise self.error("circuit '{}' is {}".format(self.name, self.state))
+
+    def _on_failure(self):
+        with self._lock:
+            self._failed += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self._failed >= self.failures):
+                logging.warning("circuit '{}' opened after {} failures".format(self.name, self._failed))
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def _on_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logging.warning("circuit '{}' closed".format(self.name))
+            self.state = self.CLOSED
+            self._failed = 0
@@ -1,5 +1,115 @@
 import os
+from collections import OrderedDict
 
 # PRIVATE CONFIGS
 KINOTEATR_API_TOKEN = os.getenv('KINOTEATR_API_TOKEN', 'KINOTEATR_API_TOKEN')
 TELEBOT_TOKEN = os.getenv('TELEBOT_TOKEN', 'TELEBOT_TOKEN')
+
+# CACHE CONFIGS
+# seconds before cached shows for (city, date) are fetched from API again
+SHOWS_CACHE_TTL = int(os.getenv('SHOWS_CACHE_TTL', 30 * 60))
+# SQLite file with fetched schedules to serve them right after restart (empty to disable)
+# and seconds after which saved schedule is not used anymore
+SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH', 'snapshots.sqlite3')
+SNAPSHOT_MAX_AGE = int(os.getenv('SNAPSHOT_MAX_AGE', 24 * 60 * 60))
+# memory budget of cached schedules of one city in shows (SHOWS_CACHE_MAX_SHOWS_<city id> overrides it for the city)
+SHOWS_CACHE_MAX_SHOWS = int(os.getenv('SHOWS_CACHE_MAX_SHOWS', 1000000))
+
+# API CONFIGS
+# number of shows requested per page and number of pages fetched concurrently
+API_PAGE_SIZE = int(os.getenv('API_PAGE_SIZE', 500))
+API_PAGE_WORKERS = int(os.getenv('API_PAGE_WORKERS', 4))
+# seconds to wait for connection / for response, number of retries and base backoff delay in seconds
+API_CONNECT_TIMEOUT = float(os.getenv('API_CONNECT_TIMEOUT', 3.05))
+API_READ_TIMEOUT = float(os.getenv('API_READ_TIMEOUT', 10))
+API_RETRIES = int(os.getenv('API_RETRIES', 3))
+API_BACKOFF = float(os.getenv('API_BACKOFF', 0.5))
+# connections kept alive to API, shared by all concurrent fetches (prefetch, cache misses, revalidations of all cities)
+API_POOL_SIZE = int(os.getenv('API_POOL_SIZE', 32))
+
+# RESILIENCE CONFIGS
+# consecutive failed fetches after which API is not called for BREAKER_RESET_TIMEOUT seconds,
+# then a single probe fetch decides whether it is called again
+BREAKER_FAILURES = int(os.getenv('BREAKER_FAILURES', 5))
+BREAKER_RESET_TIMEOUT = int(os.getenv('BREAKER_RESET_TIMEOUT', 30))
+# seconds an expired schedule is served as is while it is refreshed in background, before refresh is tried again
+STALE_RETRY_INTERVAL = int(os.getenv('STALE_RETRY_INTERVAL', 30))
+
+# SESSION CONFIGS
+# max number of chats with active requests and seconds after which idle request is dropped
+SESSIONS_MAX_SIZE = int(os.getenv('SESSIONS_MAX_SIZE', 10000))
+SESSION_TTL = int(os.getenv('SESSION_TTL', 60 * 60))
+
+# CITY CONFIGS
+# cities offered to users as comma-separated 'kino-teatr.ua city id:name' pairs
+CITIES = OrderedDict((int(city_id), name) for city_id, name in
+                     (city.split(':', 1) for city in os.getenv('CITIES', '1:Київ').split(',')))
+# {city: cache budget}
+CITY_SHOWS_CACHE_MAX_SHOWS = {city: int(os.getenv('SHOWS_CACHE_MAX_SHOWS_{}'.format(city), SHOWS_CACHE_MAX_SHOWS))
+                              for city in CITIES}
+
+# PREFETCH CONFIGS
+# prefetch schedules of offered dates in background (1/0)
+PREFETCH = bool(int(os.getenv('PREFETCH', 1)))
+# comma-separated cities to prefetch (all offered by default), other cities are fetched when users ask for them
+PREFETCH_CITIES = [int(city) for city in os.getenv('PREFETCH_CITIES', '').split(',') if city] or list(CITIES)
+# number of offered dates starting from today (same as SELECT_DATE buttons)
+PREFETCH_DAYS = int(os.getenv('PREFETCH_DAYS', 8))
+# seconds between refreshes for today, tomorrow, ..., the last one is used for all later dates
+PREFETCH_INTERVALS = [int(interval) for interval in os.getenv('PREFETCH_INTERVALS', '600,1800,7200').split(',')]
+# seconds before failed prefetch is retried
+PREFETCH_RETRY_INTERVAL = int(os.getenv('PREFETCH_RETRY_INTERVAL', 60))
+# {city: refresh intervals}, PREFETCH_INTERVALS_<city id> overrides PREFETCH_INTERVALS for the city
+CITY_PREFETCH_INTERVALS = {city: [int(interval) for interval in os.getenv('PREFETCH_INTERVALS_{}'.format(city), '').split(',') if interval]
+                           or PREFETCH_INTERVALS for city in CITIES}
+
+# RUN MODE CONFIGS
+# 'polling' - telebot's own polling, 'longpoll' / 'webhook' - updates are processed by ChatDispatcher
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# level of logs, INFO includes latency of every API call
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FORMAT = '%(asctime)s %(levelname)s %(processName)s %(message)s'
+# number of threads running handlers and max number of updates queued or being processed
+DISPATCH_WORKERS = int(os.getenv('DISPATCH_WORKERS', 16))
+DISPATCH_MAX_IN_FLIGHT = int(os.getenv('DISPATCH_MAX_IN_FLIGHT', 256))
+# address webhook server listens on, path Telegram posts updates to
+# and public URL of that path to register with Telegram (empty to skip registration)
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('PORT', 8443))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/' + TELEBOT_TOKEN)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+
+# OUTBOX CONFIGS
+# threads sending messages to Telegram and max number of queued messages (handlers wait when it is reached)
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', 8))
+OUTBOX_MAX_SIZE = int(os.getenv('OUTBOX_MAX_SIZE', 1000))
+# messages per second to all chats, to one chat and number of messages one chat can get at once.
+# OUTBOX_RATE is for the whole bot: with WORKER_PROCESSES every worker sends at OUTBOX_RATE / WORKER_PROCESSES
+OUTBOX_RATE = float(os.getenv('OUTBOX_RATE', 30))
+OUTBOX_CHAT_RATE = float(os.getenv('OUTBOX_CHAT_RATE', 1))
+OUTBOX_CHAT_BURST = int(os.getenv('OUTBOX_CHAT_BURST', 3))
+
+# WORKER CONFIGS
+# number of processes running bot handlers in 'longpoll' / 'webhook' mode (0 - handlers run in the main process)
+WORKER_PROCESSES = int(os.getenv('WORKER_PROCESSES', 0))
+# directory with schedules main process fetches and workers map (tmpfs, e.g. /dev/shm/kinobot, is the best)
+# and seconds before worker checks it for a newer schedule
+SHARED_STORE_DIR = os.getenv('SHARED_STORE_DIR', 'schedules')
+SHARED_STORE_CHECK_INTERVAL = int(os.getenv('SHARED_STORE_CHECK_INTERVAL', 60))
+# seconds worker waits for main process to fetch a schedule missing in shared store
+WORKER_FETCH_TIMEOUT = int(os.getenv('WORKER_FETCH_TIMEOUT', 60))
+
+# METRICS CONFIGS
+# local port of Prometheus metrics endpoint (0 to disable).
+# With WORKER_PROCESSES it serves the main process (schedules, prefetch), worker i serves its handlers, sessions
+# and outbox on METRICS_PORT + 1 + i
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+# comma-separated chat ids allowed to use admin commands (e.g. /metrics)
+ADMIN_CHAT_IDS = {int(chat_id) for chat_id in os.getenv('ADMIN_CHAT_IDS', '').split(',') if chat_id}
+
+# PROFILING CONFIGS
+# fraction of handler calls sampled by profiler (0 to disable, can be changed with /profile admin command),
+# seconds between stack samples and directory for collapsed-stack files
+PROFILE_RATE = float(os.getenv('PROFILE_RATE', 0))
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', 0.005))
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
@@ -0,0 +1,124 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from telebot import types
+from config import DISPATCH_WORKERS, DISPATCH_MAX_IN_FLIGHT, WEBHOOK_PATH
+
+
+def get_chat_id(update):
+    """
+    :return: id of the chat update belongs to or None
+    """
+    message = update.message or update.edited_message
+    if message is None and update.callback_query:
+        message = update.callback_query.message
+    return message.chat.id if message else None
+
+
+class ChatDispatcher:
+    """
+    Runs bot handlers for updates on a bounded thread pool.
+    Updates of one chat are processed one by one in order they were received, updates of different chats concurrently.
+    At most max_in_flight updates are queued or processed, dispatch() blocks when the limit is reached
+    """
+    def __init__(self, bot, workers=DISPATCH_WORKERS, max_in_flight=DISPATCH_MAX_IN_FLIGHT):
+        # handlers are run by dispatcher's workers, not by bot's own pool
+        bot.threaded = False
+        self.bot = bot
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='dispatcher')
+
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        # {chat_id: deque of updates waiting for the update being processed}
+        self._queues = dict()
+        self._lock = threading.Lock()
+
+    def dispatch(self, update):
+        self._in_flight.acquire()
+
+        chat_id = get_chat_id(update)
+        with self._lock:
+            queue = self._queues.get(chat_id)
+            if queue is not None:
+                # chat is being processed by a worker - it will take this update too
+                queue.append(update)
+                return
+            self._queues[chat_id] = deque([update])
+
+        self.executor.submit(self._process_chat, chat_id)
+
+    def _process_chat(self, chat_id):
+        while True:
+            with self._lock:
+                queue = self._queues[chat_id]
+                if not queue:
+                    del self._queues[chat_id]
+                    return
+                update = queue.popleft()
+
+            try:
+                self.bot.process_new_updates([update])
+            except Exception as e:
+                logging.warning("error processing update '{}' of chat '{}': {!r}".format(update.update_id, chat_id, e))
+            finally:
+                self._in_flight.release()
+
+
+class _WebhookServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            self.send_response(403)
+            self.end_headers()
+            return
+
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            update = types.Update.de_json(json.loads(body.decode('utf-8')))
+        except Exception:
+            logging.warning('webhook received malformed update')
+            self.send_response(400)
+            self.end_headers()
+            return
+
+        self.server.dispatcher.dispatch(update)
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def create_webhook_server(dispatcher, host, port):
+    """
+    HTTP server that receives updates POSTed by Telegram (or a local stand-in) to WEBHOOK_PATH
+    """
+    server = _WebhookServer((host, port), _WebhookHandler)
+    server.dispatcher = dispatcher
+    return server
+
+
+def run_long_polling(bot, dispatcher, timeout=20):
+    """
+    Receives updates with getUpdates and hands them to dispatcher without waiting for handlers
+    """
+    offset = None
+    while True:
+        try:
+            updates = bot.get_updates(offset=offset, timeout=timeout)
+        except Exception:
+            logging.warning('getUpdates failed')
+            time.sleep(1)
+            continue
+
+        for update in updates:
+            offset = update.update_id + 1
+            dispatcher.dispatch(update)
@@ -1,36 +1,134 @@
+from array import array
+from datetime import datetime, timedelta
+
+
+# every show starts at one of 24 * 60 minutes, so their datetimes are shared
+_MIDNIGHT = datetime(1900, 1, 1)
+_TIMES = dict()
+# {'HH:MM:SS' as received from API: minutes since midnight}
+_MINUTES = dict()
+
+
+def minute_to_time(minute):
+    """
+    :param minute: minutes since midnight
+    :return: datetime(1900, 1, 1, HH, MM) as returned by datetime.strptime for 'HH:MM'
+    """
+    time = _TIMES.get(minute)
+    if time is None:
+        time = _TIMES[minute] = _MIDNIGHT + timedelta(minutes=minute)
+    return time
+
+
+def time_to_minute(time):
+    return time.hour * 60 + time.minute
+
+
+def parse_minute(text):
+    """
+    :param text: 'HH:MM:SS' time of a show. There are only a few hundred distinct ones, so each is parsed once
+    :return: minutes since midnight
+    """
+    minute = _MINUTES.get(text)
+    if minute is None:
+        minute = _MINUTES[text] = time_to_minute(datetime.strptime(text, '%H:%M:%S'))
+    return minute
+
+
 class Cinema:
+    __slots__ = ('id', 'name', 'latitude', 'longitude')
+
     def __init__(self, id, name, latitude, longitude):
         self.id = id
         self.name = name
         self.latitude = latitude
         self.longitude = longitude
-        self.distance = None
 
     def get_coordinates(self):
         return float(self.latitude), float(self.longitude)
 
 class Hall:
+    __slots__ = ('id', 'cinema_id')
+
     def __init__(self, id, cinema_id):
         self.id = id
         self.cinema_id = cinema_id
 
 class Film:
+    __slots__ = ('id', 'title')
+
     def __init__(self, id, title):
         self.id = id
         self.title = title
 
 class Show:
-    def __init__(self, id, film_id, hall_id, time):
+    """
+    View of one row of ShowTable. Film title and cinema name are looked up in schedule (ShowsInCity) by ids
+    """
+    __slots__ = ('id', 'film_id', 'hall_id', 'minute', '_schedule')
+
+    def __init__(self, id, film_id, hall_id, minute, schedule):
         self.id = id
-        self.time = time
         self.film_id = film_id
         self.hall_id = hall_id
-        self.cinema_name = None
-        self.film_title = None
+        self.minute = minute
+        self._schedule = schedule
+
+    @property
+    def time(self):
+        return minute_to_time(self.minute)
+
+    @property
+    def film_title(self):
+        return self._schedule.films[self.film_id].title
+
+    @property
+    def cinema_name(self):
+        return self._schedule.cinemas[self._schedule.halls[self.hall_id].cinema_id].name
+
+class ShowTable:
+    """
+    Shows of one cinema stored column-wise and sorted by start time (minutes since midnight).
+    Columns are arrays or read-only memoryviews of the same type (e.g. of a memory-mapped snapshot)
+    """
+    __slots__ = ('ids', 'film_ids', 'hall_ids', 'minutes')
+    COLUMNS = __slots__
+    TYPECODES = ('l', 'l', 'l', 'H')
 
+    def __init__(self, rows=()):
+        """
+        :param rows: iterable of (minute, show_id, film_id, hall_id)
+        """
+        self.ids = array('l')
+        self.film_ids = array('l')
+        self.hall_ids = array('l')
+        self.minutes = array('H')
 
+        for minute, show_id, film_id, hall_id in sorted(rows):
+            self.minutes.append(minute)
+            self.ids.append(show_id)
+            self.film_ids.append(film_id)
+            self.hall_ids.append(hall_id)
 
-    
+    @classmethod
+    def from_columns(cls, columns):
+        """
+        :param columns: sequences of COLUMNS in their order, used as they are without copying
+        """
+        table = cls.__new__(cls)
+        for column, values in zip(cls.COLUMNS, columns):
+            setattr(table, column, values)
+        return table
 
+    def __len__(self):
+        return len(self.minutes)
 
+    def __eq__(self, other):
+        return isinstance(other, ShowTable) and all(getattr(self, column) == getattr(other, column) for column in self.COLUMNS)
 
+    def get_shows(self, schedule, start, end):
+        """
+        :return: list of Show views for rows [start:end]
+        """
+        return [Show(self.ids[row], self.film_ids[row], self.hall_ids[row], self.minutes[row], schedule)
+                for row in range(start, end)]
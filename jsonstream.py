@@ -0,0 +1,104 @@
+import codecs
+import json
+import re
+
+_DECODER = json.JSONDecoder()
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+# characters that can continue a number decoded so far (e.g. '-0' of '-0.25e-3')
+_NUMBER_TAIL = re.compile(r'[0-9.eE+-]*')
+
+
+class _Reader:
+    """
+    Text decoded from chunks of bytes as far as it is needed. Consumed text is dropped when more is read
+    """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.text = ''
+        self.position = 0
+        self.exhausted = False
+
+    def read_more(self):
+        """
+        :return: False if there is nothing more to read
+        """
+        for chunk in self.chunks:
+            decoded = self.decoder.decode(chunk)
+            if decoded:
+                self.text = self.text[self.position:] + decoded
+                self.position = 0
+                return True
+        if not self.exhausted:
+            self.exhausted = True
+            self.text = self.text[self.position:] + self.decoder.decode(b'', final=True)
+            self.position = 0
+        return False
+
+    def peek(self):
+        """
+        :return: next non-whitespace character or '' at the end
+        """
+        while True:
+            self.position = _WHITESPACE.match(self.text, self.position).end()
+            if self.position < len(self.text):
+                return self.text[self.position]
+            if not self.read_more():
+                return ''
+
+    def expect(self, characters):
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError('expected one of {!r} at {!r}'.format(characters, self.text[self.position:self.position + 20]))
+        self.position += 1
+        return character
+
+    def value(self):
+        """
+        Decodes next JSON value. Value that ends exactly where read text ends (e.g. number) could continue, so it is
+        decoded again after more text is read. So is a number followed only by a part of its fraction or exponent
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self.text, self.position)
+            except ValueError:
+                if not self.read_more():
+                    raise
+                continue
+            tail = _NUMBER_TAIL.match(self.text, end).end() if isinstance(value, (int, float)) else end
+            if tail < len(self.text) or not self.read_more():
+                self.position = end
+                return value
+
+
+def iter_members(chunks, arrays=()):
+    """
+    Parses JSON object from iterable of bytes chunks (e.g. Response.iter_content) as they arrive.
+    Members named in arrays are yielded as (name, element) for every element of the array, other members as (name, value),
+    so only one element is held in memory at a time
+    """
+    reader = _Reader(chunks)
+    reader.expect('{')
+    if reader.peek() == '}':
+        reader.position += 1
+    else:
+        while True:
+            name = reader.value()
+            reader.expect(':')
+            if name in arrays and reader.peek() == '[':
+                reader.position += 1
+                if reader.peek() == ']':
+                    reader.position += 1
+                else:
+                    while True:
+                        yield name, reader.value()
+                        if reader.expect(',]') == ']':
+                            break
+            else:
+                yield name, reader.value()
+            if reader.expect(',}') == '}':
+                break
+
+    if reader.peek():
+        raise ValueError('extra data after JSON object')
@@ -0,0 +1,52 @@
+import threading
+from datetime import date
+from telebot import types
+
+
+class KeyboardCache:
+    """
+    Inline keyboards of dialogue states serialized to reply_markup JSON once, so handlers send a ready string.
+    Buttons depend on the day (e.g. dates offered to choose), so all keyboards are created again when local date changes
+    """
+    def __init__(self, create_buttons, row_width=2):
+        """
+        :param create_buttons: function of date returning {state: [Button]} for that day
+        """
+        self.create_buttons = create_buttons
+        self.row_width = row_width
+
+        # (day, {state: [Button]}, {state: reply_markup JSON}) replaced as a whole, so readers need no lock
+        self._keyboards = None
+        self._lock = threading.Lock()
+
+    def get(self, state):
+        """
+        :return: reply_markup JSON of state's keyboard for today
+        """
+        return self._get_today()[2][state]
+
+    def buttons(self, state):
+        """
+        :return: list of Buttons of state for today
+        """
+        return self._get_today()[1][state]
+
+    def _get_today(self):
+        today = date.today()
+        keyboards = self._keyboards
+        if keyboards is None or keyboards[0] != today:
+            with self._lock:
+                keyboards = self._keyboards
+                if keyboards is None or keyboards[0] != today:
+                    keyboards = self._keyboards = self._create(today)
+        return keyboards
+
+    def _create(self, day):
+        buttons = self.create_buttons(day)
+        markups = dict()
+        for state, state_buttons in buttons.items():
+            keyboard = types.InlineKeyboardMarkup(row_width=self.row_width)
+            keyboard.add(*[types.InlineKeyboardButton(text=button.text, callback_data=button.callback_data)
+                           for button in state_buttons])
+            markups[state] = keyboard.to_json()
+        return day, buttons, markups
@@ -0,0 +1,292 @@
+"""
+End-to-end load simulation of the bot.
+
+Starts local stand-ins for api.kino-teatr.ua (with configurable latency and error rate) and for Telegram Bot API,
+runs the bot in webhook mode against them and drives simulated users through the whole dialogue:
+/start -> date -> time -> list of cinemas -> location -> cinema -> film search -> film.
+Reports throughput, handler latency percentiles per step, upstream calls, outbox throughput and memory growth.
+
+    python3 loadsim.py --users 300 --api-latency 0.3 --api-error-rate 0.05
+    python3 loadsim.py --telegram-rate 30 --telegram-flood-rate 0.05
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import threading
+import time
+from collections import defaultdict, Counter
+from datetime import datetime, timedelta
+from functools import partial
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+from urllib.request import Request as HTTPRequest, urlopen
+
+# schedules should come from the fake API only
+os.environ['SNAPSHOT_PATH'] = ''
+
+import telebot
+import api
+import main
+from bench import synthesize_payload
+from config import WEBHOOK_PATH
+from dispatcher import ChatDispatcher, create_webhook_server
+from outbox import Outbox
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class FakeKinoteatrAPI:
+    """
+    Serves /rest/city/{id}/shows pages of a synthetic response
+    """
+    def __init__(self, latency=0.0, error_rate=0.0, payload=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.payload = payload or synthesize_payload()
+        self.calls = Counter()
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = parse_qs(url.query)
+                time.sleep(fake.latency)
+                if random.random() < fake.error_rate:
+                    fake.calls['errors'] += 1
+                    self._reply(503, b'')
+                    return
+                fake.calls['pages'] += 1
+                page, size = int(params['page'][0]), int(params['size'][0])
+                content = fake.payload['content']
+                body = dict(fake.payload, content=content[page * size:(page + 1) * size],
+                            totalElements=len(content), totalPages=-(-len(content) // size))
+                self._reply(200, json.dumps(body).encode('utf-8'))
+
+            def _reply(self, status, body):
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = _Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+
+
+class FakeTelegramAPI:
+    """
+    Accepts Bot API calls, counts them and answers with minimal valid results
+    """
+    def __init__(self, latency=0.0, flood_rate=0.0):
+        """
+        :param flood_rate: fraction of calls rejected with 429 Too Many Requests and retry_after 1
+        """
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.calls = Counter()
+        self._message_ids = iter(range(1, sys.maxsize))
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.do_POST()
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                method = url.path.rsplit('/', 1)[-1]
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                time.sleep(fake.latency)
+                if random.random() < fake.flood_rate:
+                    fake.calls['429'] += 1
+                    self._reply(429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests',
+                                      'parameters': {'retry_after': 1}})
+                    return
+                fake.calls[method] += 1
+                if method in ('sendMessage', 'editMessageText'):
+                    result = {'message_id': next(fake._message_ids), 'date': int(time.time()),
+                              'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'},
+                              'text': params.get('text', '')}
+                else:
+                    result = True
+                self._reply(200, {'ok': True, 'result': result})
+
+            def _reply(self, status, reply):
+                body = json.dumps(reply).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = _Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+
+
+class Simulation:
+    """
+    Runs bot in webhook mode and sends it updates of simulated users. Every user waits for the bot
+    to process an update before sending the next one, as a real user waits for the reply
+    """
+    DATES = ['c', 'з'] + [(datetime.now() + timedelta(days=days)).strftime('%d.%m') for days in range(2, 8)]
+    TIMES = ['00:00-15:59', '13:00-23:59', '00:00-23:59', '17:00-23:59']
+
+    def __init__(self, workers, max_in_flight):
+        self.dispatcher = ChatDispatcher(main.bot, workers=workers, max_in_flight=max_in_flight)
+        self.webhook = create_webhook_server(self.dispatcher, '127.0.0.1', 0)
+        self.webhook_url = 'http://127.0.0.1:{}{}'.format(self.webhook.server_port, WEBHOOK_PATH)
+
+        # {update_id: (step, threading.Event)}
+        self._pending = dict()
+        self._update_ids = iter(range(1, sys.maxsize))
+        self._lock = threading.Lock()
+        # {step: [seconds]}
+        self.latencies = defaultdict(list)
+
+        process_new_updates = main.bot.process_new_updates
+
+        def timed_process_new_updates(updates):
+            started = time.perf_counter()
+            try:
+                process_new_updates(updates)
+            finally:
+                duration = time.perf_counter() - started
+                for update in updates:
+                    with self._lock:
+                        step, done = self._pending.pop(update.update_id)
+                        self.latencies[step].append(duration)
+                    done.set()
+
+        main.bot.process_new_updates = timed_process_new_updates
+
+    def run_user(self, chat_id):
+        rnd = random.Random(chat_id)
+        self._send('start', self._message(chat_id, text='/start'))
+        self._send('date', self._callback(chat_id, rnd.choice(self.DATES)))
+        self._send('time', self._callback(chat_id, rnd.choice(self.TIMES)))
+        self._send('cinemas', self._callback(chat_id, 'get_cinemas'))
+        self._send('location', self._message(chat_id, location={'latitude': 50.35 + rnd.random() * 0.2,
+                                                                'longitude': 30.35 + rnd.random() * 0.35}))
+        self._send('cinema', self._message(chat_id, text='/{}'.format(rnd.randint(1, 10))))
+        self._send('find_film', self._callback(chat_id, 'find_film'))
+        self._send('film', self._message(chat_id, text='фільм {}'.format(rnd.randint(1, 60))))
+
+    def _send(self, step, update):
+        update_id = update['update_id'] = next(self._update_ids)
+        done = threading.Event()
+        with self._lock:
+            self._pending[update_id] = (step, done)
+        urlopen(HTTPRequest(self.webhook_url, data=json.dumps(update).encode('utf-8'), method='POST')).read()
+        done.wait()
+
+    @staticmethod
+    def _message(chat_id, text=None, location=None):
+        message = {'message_id': 1, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'},
+                   'from': {'id': chat_id, 'is_bot': False, 'first_name': 'user'}}
+        if text:
+            message['text'] = text
+            if text.startswith('/'):
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        if location:
+            message['location'] = location
+        return {'message': message}
+
+    @staticmethod
+    def _callback(chat_id, data):
+        return {'callback_query': {'id': str(chat_id), 'chat_instance': str(chat_id), 'data': data,
+                                   'from': {'id': chat_id, 'is_bot': False, 'first_name': 'user'},
+                                   'message': {'message_id': 1, 'date': int(time.time()),
+                                               'chat': {'id': chat_id, 'type': 'private'}}}}
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else 0
+
+
+def max_rss_kib():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run(users, concurrency, api_latency, api_error_rate, telegram_latency, telegram_flood_rate, telegram_rate,
+        workers, max_in_flight):
+    kinoteatr = FakeKinoteatrAPI(api_latency, api_error_rate)
+    telegram = FakeTelegramAPI(telegram_latency, telegram_flood_rate)
+    # local Bot API has no flood limits of its own, only simulated 429s
+    main.OUTBOX = Outbox(main.bot, rate=telegram_rate, chat_rate=telegram_rate)
+    api.KINOTEATR_API_URL = kinoteatr.url
+    # base_url default of _make_request is bound at import, so it is passed explicitly
+    telebot.apihelper._make_request = partial(telebot.apihelper._make_request, base_url=telegram.url + '/bot{0}/{1}')
+    simulation = Simulation(workers, max_in_flight)
+    for server in (kinoteatr.server, telegram.server, simulation.webhook):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    rss_before = max_rss_kib()
+    chat_ids = iter(range(1, users + 1))
+    chat_ids_lock = threading.Lock()
+
+    def simulate_users():
+        while True:
+            with chat_ids_lock:
+                chat_id = next(chat_ids, None)
+            if chat_id is None:
+                return
+            simulation.run_user(chat_id)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=simulate_users) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - started
+    outbox_queued = main.OUTBOX.size
+    main.OUTBOX.join()
+    drained = time.perf_counter() - started
+
+    updates = sum(len(latencies) for latencies in simulation.latencies.values())
+    print('{} users, {} updates in {:.2f}s: {:.1f} updates/s'.format(users, updates, duration, updates / duration))
+    print('{:<10} {:>8} {:>8} {:>8} {:>8}'.format('step', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    steps = list(simulation.latencies.items())
+    steps.append(('all', [latency for _, latencies in steps for latency in latencies]))
+    for step, latencies in steps:
+        print('{:<10} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f}'.format(
+            step, *(percentile(latencies, fraction) * 1000 for fraction in (0.5, 0.95, 0.99, 1))))
+    print('kino-teatr API: {}'.format(dict(kinoteatr.calls)))
+    print('Telegram API: {}'.format(dict(telegram.calls)))
+    outbox = main.OUTBOX.stats()
+    print('outbox: {}, {} queued when users finished, all sent in {:.2f}s: {:.1f} messages/s'.format(
+        outbox, outbox_queued, drained, outbox['sent'] / drained))
+    print('shows cache: {}'.format(api.SHOWS_CACHE.stats()))
+    print('sessions: {}'.format(main.CURRENT_REQUESTS.stats()))
+    print('max RSS: {} KiB -> {} KiB (+{} KiB)'.format(rss_before, max_rss_kib(), max_rss_kib() - rss_before))
+
+
+if __name__ == '__main__':
+    arguments = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arguments.add_argument('--users', type=int, default=200)
+    arguments.add_argument('--concurrency', type=int, default=50, help='users talking to the bot at the same time')
+    arguments.add_argument('--api-latency', type=float, default=0.2, help='seconds per kino-teatr API page')
+    arguments.add_argument('--api-error-rate', type=float, default=0.0)
+    arguments.add_argument('--telegram-latency', type=float, default=0.02, help='seconds per Bot API call')
+    arguments.add_argument('--telegram-flood-rate', type=float, default=0.0, help='fraction of Bot API calls rejected with 429')
+    arguments.add_argument('--telegram-rate', type=float, default=1000, help='outbox messages per second, overall and per chat')
+    arguments.add_argument('--workers', type=int, default=16, help='dispatcher threads')
+    arguments.add_argument('--max-in-flight', type=int, default=256)
+    arguments = arguments.parse_args()
+    run(arguments.users, arguments.concurrency, arguments.api_latency, arguments.api_error_rate,
+        arguments.telegram_latency, arguments.telegram_flood_rate, arguments.telegram_rate,
+        arguments.workers, arguments.max_in_flight)
@@ -1,34 +1,65 @@
 import geopy.distance
-from math import cos, asin, sqrt
+import heapq
+from array import array
+from math import cos, sin, radians
+
+
+class CinemaPoints:
+    """
+    Cinemas coordinates precomputed as unit vectors. Built once per cinema set and shared between requests
+    """
+    def __init__(self, cinemas):
+        # {cinema_id: offset of cinema's vector in self.vectors}
+        self.offsets = dict()
+        # x, y, z of every cinema one after another
+        self.vectors = array('d')
+
+        for cinema in cinemas:
+            self.offsets[cinema.id] = len(self.vectors)
+            self.vectors.extend(_unit_vector(*cinema.get_coordinates()))
+
 
 class Locator:
     """
     Class that finds nearest cinemas based on provided lat and long
     """
     @classmethod
-    def get_verified_closest(cls, latitude, longitude, cinemas, result_amount=10):
+    def get_verified_closest(cls, latitude, longitude, cinemas, result_amount=10, points=None):
         """
+        Cinemas are ranked by great-circle distance (dot product of unit vectors),
+        accurate distance is calculated only for the closest ones
         :param lat: float latitude
         :param lon: float longitude
         :param cinemas: list of cinemas to review for the closest
         :param result_amount: number of closest cinemas returned
-        :return: list of closest cinemas (Cinema objects)
+        :param points: CinemaPoints built for cinemas (or their superset). Built on the fly if not provided
+        :return: list of (Cinema object, distance in km) sorted by distance
         """
-        # calculate distance for all cinemas
-        for cinema in cinemas:
-            cinema.distance = cls._get_accurate_distance((latitude, longitude), cinema.get_coordinates())
-            
-        
-        # create list sorted by distance
-        sorted_cinemas = sorted(cinemas, key=lambda c: c.distance)
+        if points is None:
+            points = CinemaPoints(cinemas)
+
+        x, y, z = _unit_vector(latitude, longitude)
+        vectors, offsets = points.vectors, points.offsets
+
+        def closeness(cinema):
+            offset = offsets[cinema.id]
+            return x * vectors[offset] + y * vectors[offset + 1] + z * vectors[offset + 2]
 
-        # check length of result and re-assign if needed
-        if len(sorted_cinemas) < result_amount:
-            result_amount = len(sorted_cinemas)
+        # the bigger dot product is, the closer cinema is
+        closest = heapq.nlargest(result_amount, cinemas, key=closeness)
 
-        return sorted_cinemas[:result_amount]
+        distances = [(cinema, cls._get_accurate_distance((latitude, longitude), cinema.get_coordinates()))
+                     for cinema in closest]
+        distances.sort(key=lambda item: item[1])
+
+        return distances
 
 
     @classmethod
     def _get_accurate_distance(cls, coords_1, coords_2):
         return geopy.distance.vincenty(coords_1, coords_2).km
+
+
+def _unit_vector(latitude, longitude):
+    latitude, longitude = radians(float(latitude)), radians(float(longitude))
+    return cos(latitude) * cos(longitude), cos(latitude) * sin(longitude), sin(latitude)
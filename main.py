@@ -1,10 +1,23 @@
-from collections import defaultdict, namedtuple
-from datetime import datetime, timedelta
-from telebot import types, TeleBot
-from config import TELEBOT_TOKEN
+import logging
+from collections import namedtuple
+from datetime import timedelta
+from telebot import TeleBot
+from config import (TELEBOT_TOKEN, PREFETCH, BOT_MODE, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_URL,
+                    METRICS_PORT, ADMIN_CHAT_IDS, CITIES, PREFETCH_CITIES, CITY_PREFETCH_INTERVALS, PREFETCH_INTERVALS,
+                    WORKER_PROCESSES, SHARED_STORE_DIR, LOG_LEVEL, LOG_FORMAT, SNAPSHOT_PATH, OUTBOX_RATE)
 from phrases import Phrases
 from request import Request
-from parser import ParsingError
+from api import SHOWS_CACHE, APIError
+from parser import Parser, ParsingError
+from sessions import SessionStore
+from prefetch import Prefetcher
+from dispatcher import ChatDispatcher, create_webhook_server, run_long_polling
+from workers import WorkerPool
+from outbox import Outbox
+from keyboards import KeyboardCache
+from snapshot import SnapshotStore, SharedScheduleStore
+from metrics import METRICS, HANDLER_SECONDS, start_metrics_server
+from profiler import PROFILER
 
 
 WEEK_DAYS = {'Mon': 'Пн',
@@ -16,166 +29,390 @@ WEEK_DAYS = {'Mon': 'Пн',
              'Sun': 'Нд'}
 
 # User states to handle the flow of dialogue with bot
-SELECT_DATE, SELECT_TIME, SELECT_CINEMA = range(3)
+SELECT_CITY, SELECT_DATE, SELECT_TIME, SELECT_CINEMA, SELECT_FILM = range(5)
+
+# city is asked only if more than one is offered
+FIRST_STATE = SELECT_CITY if len(CITIES) > 1 else SELECT_DATE
 
 # Current user's request
-CURRENT_REQUESTS = defaultdict(lambda:  Request(SELECT_DATE))
+CURRENT_REQUESTS = SessionStore(lambda:  Request(FIRST_STATE))
+
+METRICS.gauge('sessions', 'Chats with active request', lambda: len(CURRENT_REQUESTS))
+METRICS.gauge('sessions_evicted_total', 'Requests evicted from full session store', lambda: CURRENT_REQUESTS.evictions, type='counter')
+METRICS.gauge('sessions_expired_total', 'Requests expired after being idle', lambda: CURRENT_REQUESTS.expirations, type='counter')
 
 # To handle callback_query buttons
 Button = namedtuple('Button', ['text', 'callback_data'])
 
-def create_date_buttons(days):
-    now = datetime.now()
-    dates = [now + timedelta(days=x) for x in range(2, days + 2)]
+def create_date_buttons(today, days):
+    dates = [today + timedelta(days=x) for x in range(2, days + 2)]
     return [Button(WEEK_DAYS.get(date.strftime('%a')) + ' ' + date.strftime('%d.%m'),
                    date.strftime('%d.%m')) for date in dates]
 
-BUTTONS = {SELECT_DATE: [Button('Cьогодні', 'c'),
-                         Button('Завтра', 'з'),
-                         *[button for button in create_date_buttons(6)]],
-           SELECT_TIME: [Button('До обіду', '00:00-15:59'),
-                         Button('Після обіду', '13:00-23:59'),
-                         Button('Цілий день', '00:00-23:59'),
-                         Button('Ввечорі', '17:00-23:59')],
-           SELECT_CINEMA: [Button('Перелік кінотеатрів', 'get_cinemas')]
-           }
-
-
-bot = TeleBot(TELEBOT_TOKEN)
+def create_buttons(today):
+    """
+    :return: {state: buttons} offered on the given day
+    """
+    return {SELECT_CITY: [Button(name, str(city)) for city, name in CITIES.items()],
+            SELECT_DATE: [Button('Cьогодні', 'c'),
+                          Button('Завтра', 'з'),
+                          *[button for button in create_date_buttons(today, 6)]],
+            SELECT_TIME: [Button('До обіду', '00:00-15:59'),
+                          Button('Після обіду', '13:00-23:59'),
+                          Button('Цілий день', '00:00-23:59'),
+                          Button('Ввечорі', '17:00-23:59')],
+            SELECT_CINEMA: [Button('Перелік кінотеатрів', 'get_cinemas'),
+                            Button('Пошук фільму', 'find_film')]
+            }
+
+# serialized keyboards, date buttons move forward at midnight
+KEYBOARDS = KeyboardCache(create_buttons)
+
+# answers for SELECT_TIME buttons are precomputed in every cached schedule
+SHOWS_CACHE.windows = [Parser.parse_time(button.callback_data) for button in KEYBOARDS.buttons(SELECT_TIME)]
+
+
+# telebot's own handler threads are needed only by its polling, other modes run handlers with ChatDispatcher.
+# Without them the fork server that worker processes are forked from runs no thread
+bot = TeleBot(TELEBOT_TOKEN, threaded=BOT_MODE == 'polling')
+# number of worker processes running handlers (0 - handlers run in this process)
+WORKERS = WORKER_PROCESSES if BOT_MODE in ('webhook', 'longpoll') else 0
+
+# replies are sent by outbox threads within Telegram's rate limits, handlers do not wait for them.
+# Every worker process has its own outbox sending at its share of OUTBOX_RATE; a chat is served by one worker,
+# so per chat limits hold as they are
+OUTBOX = Outbox(bot, rate=OUTBOX_RATE / max(WORKERS, 1))
+
+METRICS.gauge('outbox_queued', 'Messages waiting in outbox', lambda: OUTBOX.size)
+METRICS.gauge('outbox_sent_total', 'Messages sent by outbox', lambda: OUTBOX.sent, type='counter')
+METRICS.gauge('outbox_failed_total', 'Messages outbox failed to send', lambda: OUTBOX.failed, type='counter')
+METRICS.gauge('outbox_retried_total', 'Messages retried after 429 Too Many Requests', lambda: OUTBOX.retried, type='counter')
+METRICS.gauge('outbox_coalesced_total', 'Edits replaced by a newer edit of the same message', lambda: OUTBOX.coalesced, type='counter')
+
+
+def describe_request(update):
+    """
+    :return: state of user's request for profiler stacks
+    """
+    message = getattr(update, 'message', None) or update
+    request = CURRENT_REQUESTS.get(message.chat.id)
+    if not request:
+        return 'no request'
+    return 'state={} city={} date={} cinema={}'.format(request.state, request.city, request.date,
+                                                       request.cinema.id if request.cinema else None)
+
+
+def instrumented(name):
+    """
+    Handler decorator: latency histogram and sampling profiler
+    """
+    def decorator(handler):
+        return HANDLER_SECONDS.time(name)(PROFILER.profile(name, describe_request)(handler))
+    return decorator
 
 def create_inline_keyboard(message):
-    keyboard = types.InlineKeyboardMarkup(row_width=2)
-    buttons = [types.InlineKeyboardButton(text=button.text, callback_data=button.callback_data)
-            for button in BUTTONS[get_state(message)]]
-    keyboard.add(*buttons)
-    return keyboard
+    """
+    :return: reply_markup JSON of the keyboard of chat's state
+    """
+    return KEYBOARDS.get(get_state(message))
 
 
 def get_state(message):
-    return CURRENT_REQUESTS[message.chat.id].state
+    """
+    :return: state of chat's request or None if chat has no session
+    """
+    request = CURRENT_REQUESTS.get(message.chat.id)
+    return request.state if request else None
 
 
 def update_state(message, state):
-    CURRENT_REQUESTS[message.chat.id].state = state
+    CURRENT_REQUESTS.get(message.chat.id).state = state
 
 
-# STEP 1 - (no state yet) - Asking for a DATE from user
+# STEP 1 - (no state yet) - Asking for a CITY (or DATE if there is one city) from user
 @bot.message_handler(commands=['start'])
+@instrumented('start_dialogue')
 def start_dialogue(message):
 
-    # safety POP from current requests
-    CURRENT_REQUESTS.pop(message.chat.id, None)
-
-    # create new request. Request has now SELECT_DATE state
-    CURRENT_REQUESTS[message.chat.id].set_chat_id(message.chat.id)
+    # create new request replacing the old one. Request has now FIRST_STATE state
+    CURRENT_REQUESTS.create(message.chat.id).set_chat_id(message.chat.id)
     
-    bot.send_message(message.chat.id, Phrases.WHEN, reply_markup=create_inline_keyboard(message))
+    OUTBOX.send_message(message.chat.id, Phrases.WHICH_CITY if FIRST_STATE == SELECT_CITY else Phrases.WHEN,
+                     reply_markup=create_inline_keyboard(message))
+
+
+# ADMIN - short summary of metrics
+@bot.message_handler(commands=['metrics'], func=lambda message: message.chat.id in ADMIN_CHAT_IDS)
+def send_metrics(message):
+    OUTBOX.send_message(message.chat.id, METRICS.summary() or '-')
+
+
+# ADMIN - '/profile 0.1' samples 10% of handler calls, '/profile dump' writes collected stacks, '/profile 0' stops
+@bot.message_handler(commands=['profile'], func=lambda message: message.chat.id in ADMIN_CHAT_IDS)
+def control_profiler(message):
+    argument = message.text.split()[1] if len(message.text.split()) > 1 else 'dump'
+    if argument == 'dump':
+        OUTBOX.send_message(message.chat.id, '\n'.join(PROFILER.dump()) or '-')
+        return
+    try:
+        PROFILER.rate = min(max(float(argument), 0), 1)
+    except ValueError:
+        OUTBOX.send_message(message.chat.id, Phrases.INPUT_ERROR)
+        return
+    OUTBOX.send_message(message.chat.id, 'profiling rate {}'.format(PROFILER.rate))
+
+
+# STEP 1.A - SELECT_CITY state - Checking city and asking for a date from user
+@bot.callback_query_handler(func=lambda callback_query: get_state(callback_query.message) == SELECT_CITY)
+@instrumented('city_choosing_inline')
+def city_choosing_inline(callback_query):
+    message = callback_query.message
+    request = CURRENT_REQUESTS.get(message.chat.id)
+
+    try:
+        request.set_city_from_cb_data(callback_query.data)
+    except ParsingError:
+        OUTBOX.send_message(message.chat.id, Phrases.INPUT_ERROR)
+        return
+
+    update_state(message, SELECT_DATE)
+
+    OUTBOX.edit_message_text(Phrases.WHEN, chat_id=message.chat.id,
+                              message_id=message.message_id, reply_markup=create_inline_keyboard(message))
 
 
 # STEP 2 - SELECT_DATE state - Checking date and asking for a time from user
 @bot.callback_query_handler(func=lambda callback_query: get_state(callback_query.message) == SELECT_DATE)
+@instrumented('date_choosing_inline')
 def date_choosing_inline(callback_query):
     message = callback_query.message
-    request = CURRENT_REQUESTS[message.chat.id]
+    request = CURRENT_REQUESTS.get(message.chat.id)
 
     # checking/assigning date
     try:
         request.set_date_from_cb_data(callback_query.data)
     except ParsingError:
-        bot.send_message(message.chat.id, Phrases.INPUT_ERROR)
+        OUTBOX.send_message(message.chat.id, Phrases.INPUT_ERROR)
         return
     except Exception:
-        bot.send_message(message.chat.id, Phrases.BOT_ERROR)
+        OUTBOX.send_message(message.chat.id, Phrases.BOT_ERROR)
         CURRENT_REQUESTS.pop(message.chat.id, None)
         return
     
     # DATE checked, not asking to select time
     update_state(message, SELECT_TIME)
 
-    bot.edit_message_text(Phrases.WHEN, chat_id=message.chat.id,
+    OUTBOX.edit_message_text(Phrases.WHEN, chat_id=message.chat.id,
                               message_id=message.message_id, reply_markup=create_inline_keyboard(message))
 
 
 # STEP 3 - SELECT_TIME state - Checking time and asking for a cinema from user
 @bot.callback_query_handler(func=lambda callback_query: get_state(callback_query.message) == SELECT_TIME)
+@instrumented('time_choosing_inline')
 def time_choosing_inline(callback_query):
     message = callback_query.message
-    request = CURRENT_REQUESTS[message.chat.id]
+    request = CURRENT_REQUESTS.get(message.chat.id)
 
     # CHECKING TIME
     try:
         request.set_times_from_cb_data(callback_query.data)
     except ParsingError:
-        bot.send_message(message.chat.id, Phrases.INPUT_ERROR)
+        OUTBOX.send_message(message.chat.id, Phrases.INPUT_ERROR)
         return
     except Exception:
-        bot.send_message(message.chat.id, Phrases.BOT_ERROR)
+        OUTBOX.send_message(message.chat.id, Phrases.BOT_ERROR)
         CURRENT_REQUESTS.pop(message.chat.id, None)
         return
     
     update_state(message, SELECT_CINEMA)
 
-    bot.edit_message_text(chat_id=message.chat.id, text=Phrases.WHICH_CINEMA,
+    OUTBOX.edit_message_text(chat_id=message.chat.id, text=Phrases.WHICH_CINEMA,
                     message_id=message.message_id, reply_markup=create_inline_keyboard(message))
 
     
 
 # STEP 4.A - SELECT_CINEMA - Sending the list of all cinemas with available sessions on date at time selected earlier
-@bot.callback_query_handler(func=lambda callback_query: callback_query.data == 'get_cinemas' and get_state(callback_query.message) == SELECT_CINEMA)
+@bot.callback_query_handler(func=lambda callback_query: callback_query.data == 'get_cinemas' and get_state(callback_query.message) in (SELECT_CINEMA, SELECT_FILM))
+@instrumented('send_available_cinemas')
 def send_available_cinemas(callback_query):
 
     message = callback_query.message
-    request = CURRENT_REQUESTS[message.chat.id]
+    request = CURRENT_REQUESTS.get(message.chat.id)
+    # button can be pressed again during film search
+    update_state(message, SELECT_CINEMA)
 
     try:
         cinemas = request.get_cinemas()
+    except APIError:
+        # request is kept, so the same button can be pressed again
+        OUTBOX.send_message(message.chat.id, Phrases.API_UNAVAILABLE)
+        return
     except Exception:
-        bot.send_message(message.chat.id, Phrases.BOT_ERROR)
+        OUTBOX.send_message(message.chat.id, Phrases.BOT_ERROR)
         CURRENT_REQUESTS.pop(message.chat.id, None)
         return
 
-    bot.send_message(message.chat.id, Phrases.string_cinemas(cinemas))
+    reply = Phrases.string_data_as_of(request.shows_in_city) + Phrases.string_cinemas(cinemas, request.distances)
+    for part in Phrases.split_message(reply):
+        OUTBOX.send_message(message.chat.id, part)
 
 # STEP 4.B - SELECT_CINEMA - if location sent - sending 10 (or less if less) closest cinemas with available sessions on date at time selected earlier
 @bot.message_handler(content_types=['location'], func=lambda message: get_state(message) == SELECT_CINEMA)
+@instrumented('calculate_and_send_closest_cinemas')
 def calculate_and_send_closest_cinemas(message):
 
-    bot.send_message(message.chat.id, 'Шукаю...')
+    OUTBOX.send_message(message.chat.id, 'Шукаю...')
 
-    request = CURRENT_REQUESTS[message.chat.id]
+    request = CURRENT_REQUESTS.get(message.chat.id)
 
-    cinemas = request.get_closest_cinemas(message.location.latitude, message.location.longitude) 
+    try:
+        cinemas = request.get_closest_cinemas(message.location.latitude, message.location.longitude)
+    except APIError:
+        OUTBOX.send_message(message.chat.id, Phrases.API_UNAVAILABLE)
+        return
+    except Exception:
+        OUTBOX.send_message(message.chat.id, Phrases.BOT_ERROR)
+        CURRENT_REQUESTS.pop(message.chat.id, None)
+        return
 
-    bot.send_message(message.chat.id, Phrases.string_cinemas(cinemas))
+    reply = Phrases.string_data_as_of(request.shows_in_city) + Phrases.string_cinemas(cinemas, request.distances)
+    for part in Phrases.split_message(reply):
+        OUTBOX.send_message(message.chat.id, part)
     
 
+# STEP 4.C - SELECT_CINEMA - switching to search of cinemas by film
+@bot.callback_query_handler(func=lambda callback_query: callback_query.data == 'find_film' and get_state(callback_query.message) in (SELECT_CINEMA, SELECT_FILM))
+@instrumented('start_film_search')
+def start_film_search(callback_query):
+    message = callback_query.message
+    update_state(message, SELECT_FILM)
+
+    OUTBOX.send_message(message.chat.id, Phrases.WHICH_FILM)
+
+
+# STEP 5.B - SELECT_FILM - sending cinemas and times of the film found by title
+@bot.message_handler(func=lambda message: get_state(message) == SELECT_FILM)
+@instrumented('sending_film_shows')
+def sending_film_shows(message):
+    request = CURRENT_REQUESTS.get(message.chat.id)
+
+    try:
+        request.set_film_from_message(message)
+    except ParsingError:
+        OUTBOX.send_message(message.chat.id, Phrases.FILM_NOT_FOUND)
+        return
+    except APIError:
+        OUTBOX.send_message(message.chat.id, Phrases.API_UNAVAILABLE)
+        return
+    except Exception:
+        OUTBOX.send_message(message.chat.id, Phrases.BOT_ERROR)
+        CURRENT_REQUESTS.pop(message.chat.id, None)
+        return
+
+    send_film_shows(message, request)
+
+
+# STEP 5.C - SELECT_FILM - if location sent - sending cinemas with the film again, the closest first
+@bot.message_handler(content_types=['location'], func=lambda message: get_state(message) == SELECT_FILM)
+@instrumented('ranking_film_shows')
+def ranking_film_shows(message):
+    request = CURRENT_REQUESTS.get(message.chat.id)
+    request.set_location(message.location.latitude, message.location.longitude)
+
+    if request.film is None:
+        OUTBOX.send_message(message.chat.id, Phrases.WHICH_FILM)
+        return
+
+    send_film_shows(message, request)
+
+
+def send_film_shows(message, request):
+    try:
+        film_shows = request.get_film_shows()
+    except APIError:
+        OUTBOX.send_message(message.chat.id, Phrases.API_UNAVAILABLE)
+        return
+    except Exception:
+        OUTBOX.send_message(message.chat.id, Phrases.BOT_ERROR)
+        CURRENT_REQUESTS.pop(message.chat.id, None)
+        return
+
+    reply = Phrases.string_data_as_of(request.shows_in_city)
+    reply += Phrases.string_film_shows(request.film, film_shows, request.distances)
+
+    for part in Phrases.split_message(reply):
+        OUTBOX.send_message(message.chat.id, part)
+
+
 # STEP 5 - sending shows for selected cinema/date/time
 @bot.message_handler(func=lambda message: get_state(message) == SELECT_CINEMA)
+@instrumented('sending_sessions')
 def sending_sessions(message):
-    request = CURRENT_REQUESTS[message.chat.id]
+    request = CURRENT_REQUESTS.get(message.chat.id)
 
     try:
         request.set_cinema_from_message(message)
     except ParsingError:
-        bot.send_message(message.chat.id, Phrases.INPUT_ERROR)
+        OUTBOX.send_message(message.chat.id, Phrases.INPUT_ERROR)
         return
     except Exception:
-        bot.send_message(message.chat.id, Phrases.BOT_ERROR)
+        OUTBOX.send_message(message.chat.id, Phrases.BOT_ERROR)
         CURRENT_REQUESTS.pop(message.chat.id, None)
         return
 
     try:
-        shows = request.get_shows()
+        shows = request.get_shows_reply()
+    except APIError:
+        OUTBOX.send_message(message.chat.id, Phrases.API_UNAVAILABLE)
+        return
     except Exception:
-        bot.send_message(message.chat.id, Phrases.BOT_ERROR)
+        OUTBOX.send_message(message.chat.id, Phrases.BOT_ERROR)
         CURRENT_REQUESTS.pop(message.chat.id, None)
         return
  
     reply = Phrases.string_request(request)
-    reply += Phrases.string_shows(shows)
+    reply += Phrases.string_data_as_of(request.shows_in_city)
+    reply += shows
     
-    bot.send_message(message.chat.id, reply)
+    for part in Phrases.split_message(reply):
+        OUTBOX.send_message(message.chat.id, part)
+
+
+# session was evicted or expired (or never started) - starting dialogue again
+@bot.callback_query_handler(func=lambda callback_query: get_state(callback_query.message) is None)
+def restart_dialogue_inline(callback_query):
+    restart_dialogue(callback_query.message)
+
+
+@bot.message_handler(content_types=['text', 'location'], func=lambda message: get_state(message) is None)
+def restart_dialogue(message):
+    OUTBOX.send_message(message.chat.id, Phrases.SESSION_EXPIRED)
+    start_dialogue(message)
 
 
 if __name__ == '__main__':
-    bot.polling(none_stop=True)
+    logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
+
+    dispatcher = None
+    if WORKERS:
+        dispatcher = WorkerPool(__name__, SHOWS_CACHE, SharedScheduleStore(SHARED_STORE_DIR))
+        dispatcher.start()
+    elif SNAPSHOT_PATH:
+        SHOWS_CACHE.use_snapshots(SnapshotStore(SNAPSHOT_PATH))
+
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+    if PREFETCH:
+        for city in PREFETCH_CITIES:
+            Prefetcher(SHOWS_CACHE, city, intervals=CITY_PREFETCH_INTERVALS.get(city, PREFETCH_INTERVALS)).start()
+
+    if BOT_MODE == 'webhook':
+        if WEBHOOK_URL:
+            bot.remove_webhook()
+            bot.set_webhook(url=WEBHOOK_URL)
+        create_webhook_server(dispatcher or ChatDispatcher(bot), WEBHOOK_HOST, WEBHOOK_PORT).serve_forever()
+    elif BOT_MODE == 'longpoll':
+        bot.remove_webhook()
+        run_long_polling(bot, dispatcher or ChatDispatcher(bot))
+    else:
+        bot.polling(none_stop=True)
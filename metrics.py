@@ -0,0 +1,155 @@
+import functools
+import threading
+import time
+from bisect import bisect_left
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+# seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# bytes
+SIZE_BUCKETS = (1024, 10 * 1024, 100 * 1024, 500 * 1024, 1024 * 1024, 5 * 1024 * 1024, 20 * 1024 * 1024)
+
+
+class Histogram:
+    """
+    Prometheus-style histogram with optional single label (e.g. handler name)
+    """
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, label=None):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.label = label
+
+        # {label value: [count per bucket (last is +Inf), sum]}
+        self._series = dict()
+        self._lock = threading.Lock()
+
+    def observe(self, value, label_value=None):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def time(self, label_value=None):
+        """
+        Decorator observing duration of every call of decorated function
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - started, label_value)
+            return wrapper
+        return decorator
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            series = [(label_value, list(values)) for label_value, values in self._series.items()]
+
+        for label_value, values in series:
+            labels = '{}="{}"'.format(self.label, label_value) if self.label else ''
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values):
+                cumulative += count
+                lines.append('{}_bucket{{{}}} {}'.format(self.name, ','.join(filter(None, (labels, 'le="{}"'.format(bound)))), cumulative))
+            suffix = '{' + labels + '}' if labels else ''
+            lines.append('{}_sum{} {}'.format(self.name, suffix, values[-1]))
+            lines.append('{}_count{} {}'.format(self.name, suffix, cumulative))
+        return lines
+
+    def summary(self):
+        with self._lock:
+            series = [(label_value, sum(values[:-1]), values[-1]) for label_value, values in self._series.items()]
+        return ['{}{} count={} avg={:.4f}'.format(self.name, '[{}]'.format(label_value) if label_value else '', count, total / count)
+                for label_value, count, total in series if count]
+
+
+class Gauge:
+    """
+    Value read from a callback when metrics are rendered, so nothing is done on hot path.
+    Type is 'counter' for values that only grow (e.g. cache hits)
+    """
+    def __init__(self, name, help, callback, type='gauge'):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        self.type = type
+
+    def render(self):
+        return ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.type),
+                '{} {}'.format(self.name, self.callback())]
+
+    def summary(self):
+        return ['{} {}'.format(self.name, self.callback())]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = list()
+
+    def histogram(self, *args, **kwargs):
+        return self._register(Histogram(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self._register(Gauge(*args, **kwargs))
+
+    def render(self):
+        """
+        :return: all metrics in Prometheus text exposition format
+        """
+        return '\n'.join(line for metric in self.metrics for line in metric.render()) + '\n'
+
+    def summary(self):
+        """
+        :return: short human-readable metrics (count and average of histograms) e.g. for a bot message
+        """
+        return '\n'.join(line for metric in self.metrics for line in metric.summary())
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+
+METRICS = Registry()
+
+HANDLER_SECONDS = METRICS.histogram('bot_handler_seconds', 'Time spent in bot handler', label='handler')
+API_PAGE_SECONDS = METRICS.histogram('api_page_seconds', 'Time to fetch one page of kino-teatr API response including retries')
+API_PAGE_BYTES = METRICS.histogram('api_page_bytes', 'Size of one page of kino-teatr API response', buckets=SIZE_BUCKETS)
+API_SHOWS_SECONDS = METRICS.histogram('api_shows_seconds', 'Time to fetch all pages of shows in city on date')
+OUTBOX_SEND_SECONDS = METRICS.histogram('outbox_send_seconds', 'Time of one Bot API call made by outbox')
+OUTBOX_WAIT_SECONDS = METRICS.histogram('outbox_wait_seconds', 'Time from queuing a message in outbox until it was sent')
+SHOWS_PARSE_SECONDS = METRICS.histogram('shows_parse_seconds', 'Time to build show tables of ShowsInCity from parsed API response')
+
+
+class _MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = METRICS.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, host='127.0.0.1'):
+    """
+    Serves METRICS in Prometheus text format on every path in a background thread
+    """
+    server = _MetricsServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
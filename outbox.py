@@ -0,0 +1,241 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from telebot.apihelper import ApiException
+from metrics import OUTBOX_SEND_SECONDS, OUTBOX_WAIT_SECONDS
+from config import OUTBOX_WORKERS, OUTBOX_MAX_SIZE, OUTBOX_RATE, OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST
+
+
+class _TokenBucket:
+    """
+    Allows rate calls per second on average and up to capacity calls at once
+    """
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def delay(self, now):
+        """
+        :return: seconds until a call is allowed
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class _Call:
+    __slots__ = ('method', 'args', 'kwargs', 'queued_at')
+
+    def __init__(self, method, args, kwargs):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.queued_at = time.perf_counter()
+
+
+class _Chat:
+    __slots__ = ('calls', 'bucket', 'ready_at', 'sending')
+
+    def __init__(self, bucket):
+        # calls waiting to be sent in order they were queued
+        self.calls = deque()
+        self.bucket = bucket
+        # time.monotonic() before which nothing is sent to the chat (Telegram's retry_after)
+        self.ready_at = 0
+        self.sending = False
+
+
+class Outbox:
+    """
+    Queue of outgoing Bot API calls sent by a pool of threads, so handlers do not wait for Telegram.
+    Messages of one chat are sent one by one in order they were queued, at most chat_rate per second (chat_burst at once)
+    and rate per second for all chats. Calls rejected with 429 are retried after retry_after seconds.
+    Queued edit of a message is replaced by a newer edit of the same message.
+    At most max_size calls are queued, queuing more blocks the handler until there is space.
+    Sending threads are started on first use, so in the process (e.g. worker) that uses outbox
+    """
+    def __init__(self, bot, workers=OUTBOX_WORKERS, max_size=OUTBOX_MAX_SIZE, rate=OUTBOX_RATE,
+                 chat_rate=OUTBOX_CHAT_RATE, chat_burst=OUTBOX_CHAT_BURST):
+        self.bot = bot
+        self.workers = workers
+        self.max_size = max_size
+        self.rate = rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.size = 0
+        self.max_seen_size = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.coalesced = 0
+
+        # {chat_id: _Chat}
+        self._chats = dict()
+        # heap of (time.monotonic() chat can be sent to, sequence number, chat_id) of chats with queued calls
+        self._ready = []
+        self._sequence = itertools.count()
+        # {(chat_id, message_id): queued edit}
+        self._edits = dict()
+        # rate below 1 (e.g. share of one of many worker processes) still lets a message through
+        self._bucket = _TokenBucket(rate, max(rate, 1), time.monotonic())
+        self._condition = threading.Condition()
+        self._purged_at = time.monotonic()
+        self._threads = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        self._put(chat_id, _Call('send_message', (chat_id, text), kwargs))
+
+    def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        with self._condition:
+            edit = self._edits.get((chat_id, message_id))
+            if edit is not None:
+                # message was not edited yet, so only the last text is sent
+                edit.args = (text,)
+                edit.kwargs = dict(kwargs, chat_id=chat_id, message_id=message_id)
+                self.coalesced += 1
+                return
+        self._put(chat_id, _Call('edit_message_text', (text,), dict(kwargs, chat_id=chat_id, message_id=message_id)),
+                  edit_key=(chat_id, message_id))
+
+    def join(self, timeout=None):
+        """
+        Waits until all queued calls are sent
+        :return: False on timeout
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: not self.size, timeout)
+
+    def stats(self):
+        with self._condition:
+            return {'queued': self.size,
+                    'max_queued': self.max_seen_size,
+                    'sent': self.sent,
+                    'failed': self.failed,
+                    'retried': self.retried,
+                    'coalesced': self.coalesced}
+
+    def _put(self, chat_id, call, edit_key=None):
+        with self._condition:
+            if not self._threads:
+                self._start()
+            self._condition.wait_for(lambda: self.size < self.max_size)
+            now = time.monotonic()
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                self._purge_idle(now)
+                chat = self._chats[chat_id] = _Chat(_TokenBucket(self.chat_rate, self.chat_burst, now))
+
+            chat.calls.append(call)
+            if edit_key:
+                self._edits[edit_key] = call
+            self.size += 1
+            self.max_seen_size = max(self.max_seen_size, self.size)
+            if len(chat.calls) == 1 and not chat.sending:
+                self._schedule(chat_id, chat, now)
+            self._condition.notify_all()
+
+    def _start(self):
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, name='outbox-{}'.format(index), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _schedule(self, chat_id, chat, now):
+        ready_at = max(chat.ready_at, now + chat.bucket.delay(now))
+        heapq.heappush(self._ready, (ready_at, next(self._sequence), chat_id))
+
+    def _take(self):
+        """
+        Waits for a chat that can be sent to and reserves its first call
+        """
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                if self._ready and self._ready[0][0] <= now:
+                    delay = self._bucket.delay(now)
+                    if not delay:
+                        _, _, chat_id = heapq.heappop(self._ready)
+                        chat = self._chats[chat_id]
+                        call = chat.calls.popleft()
+                        if call.method == 'edit_message_text':
+                            self._edits.pop((chat_id, call.kwargs['message_id']), None)
+                        chat.sending = True
+                        chat.bucket.delay(now)
+                        chat.bucket.take()
+                        self._bucket.take()
+                        return chat_id, chat, call
+                    self._condition.wait(delay)
+                else:
+                    self._condition.wait(self._ready[0][0] - now if self._ready else None)
+
+    def _work(self):
+        while True:
+            chat_id, chat, call = self._take()
+            retry_after = None
+            failed = False
+            started = time.perf_counter()
+            try:
+                getattr(self.bot, call.method)(*call.args, **call.kwargs)
+            except ApiException as e:
+                retry_after = self._get_retry_after(e)
+                if retry_after is None:
+                    logging.warning("outbox {} to chat '{}' failed: {!r}".format(call.method, chat_id, e))
+                    failed = True
+            except Exception as e:
+                logging.warning("outbox {} to chat '{}' failed: {!r}".format(call.method, chat_id, e))
+                failed = True
+            OUTBOX_SEND_SECONDS.observe(time.perf_counter() - started)
+
+            with self._condition:
+                chat.sending = False
+                now = time.monotonic()
+                if retry_after is not None:
+                    logging.warning("outbox {} to chat '{}' is retried after {}s".format(call.method, chat_id, retry_after))
+                    chat.calls.appendleft(call)
+                    chat.ready_at = now + retry_after
+                    self.retried += 1
+                else:
+                    OUTBOX_WAIT_SECONDS.observe(time.perf_counter() - call.queued_at)
+                    self.size -= 1
+                    if failed:
+                        self.failed += 1
+                    else:
+                        self.sent += 1
+                if chat.calls:
+                    self._schedule(chat_id, chat, now)
+                self._condition.notify_all()
+
+    @staticmethod
+    def _get_retry_after(exception):
+        """
+        :return: seconds to wait if Telegram rejected the call with 429 Too Many Requests, otherwise None
+        """
+        result = getattr(exception, 'result', None)
+        if result is None or getattr(result, 'status_code', None) != 429:
+            return None
+        try:
+            return int(result.json()['parameters']['retry_after'])
+        except (ValueError, KeyError, TypeError):
+            return 1
+
+    def _purge_idle(self, now):
+        """
+        Forgets chats with nothing queued whose rate limit has passed, at most once per second
+        """
+        if now - self._purged_at < 1:
+            return
+        self._purged_at = now
+        idle_for = self.chat_burst / self.chat_rate
+        for chat_id in [chat_id for chat_id, chat in self._chats.items()
+                        if not chat.calls and not chat.sending and now - chat.bucket.updated >= idle_for and now >= chat.ready_at]:
+            del self._chats[chat_id]
@@ -65,12 +65,34 @@ class Parser:
 
 
     @classmethod
-    def parse_cinema(cls, message, cinemas, cinemas_ids_mapping):
+    def parse_city(cls, message, cities):
+        """
+        Method recognizes city id as sent by SELECT_CITY buttons
+        Raises UserInputError if city is not among {cities}
+        :param message: callback data received in Telegram
+        :param cities: {city id: name} of offered cities
+        :return: city id in int
+        """
+        try:
+            city = int(message)
+        except ValueError:
+            logging.warning('parse_city error converting string to int')
+            raise ParsingError
+
+        if city not in cities:
+            logging.warning('parse_city city is not offered')
+            raise ParsingError
+        return city
+
+
+    @classmethod
+    def parse_cinema(cls, message, cinemas, cinemas_ids_mapping, index=None):
         """
         Method parses User message and returns cinema objects if cinema with such name/ID is found among {cinemas}
         Raises UserInputError if not found
         :param message: message received in Telegram
         :param cinemas: list of Cinema objects to search among
+        :param index: NameIndex of cinemas names (or of their superset) to find the best match by name
         :return: Cinema object if found
         """
         cinema_id = re.findall(r'^/?([0-9]+)', message.text)
@@ -81,14 +103,38 @@ class Parser:
                 logging.warning('parse_cinema found cinema_id in message but no proper mapping')
                 pass
 
-        for cinema in cinemas:
-            if message.text.lower() in cinema.name.lower():
-                return cinema
+        if index is not None:
+            cinemas_by_id = {cinema.id: cinema for cinema in cinemas}
+            matches = index.search(message.text, candidates=cinemas_by_id)
+            if matches:
+                return cinemas_by_id[matches[0][0]]
+        else:
+            for cinema in cinemas:
+                if message.text.lower() in cinema.name.lower():
+                    return cinema
 
         logging.warning('parse_cinema no proper cinema_name in message')
         raise ParsingError
 
 
+    @classmethod
+    def parse_film(cls, message, films, index, candidates=None):
+        """
+        Method finds film which title matches User message the best
+        Raises ParsingError if no title matches
+        :param message: message received in Telegram
+        :param films: {film id: Film} of the schedule
+        :param index: NameIndex of films titles
+        :param candidates: ids of films to search among (e.g. films with shows at chosen time)
+        :return: Film object if found
+        """
+        matches = index.search(message.text, candidates=candidates, limit=1)
+        if not matches:
+            logging.warning('parse_film no proper film title in message')
+            raise ParsingError
+        return films[matches[0][0]]
+
+
     @classmethod
     def _parse_cinema_id(cls, cinema_id, cinemas_ids_mapping):
         if cinema_id in cinemas_ids_mapping:
@@ -1,32 +1,94 @@
+from datetime import datetime
+from config import CITIES
+
+
 class Phrases:  
+    WHICH_CITY = 'В якому місті шукаєте кіно?'
     WHEN = 'Коли плануєте до кінотеатру?'
     WHAT_TIME = 'В який час?'
     WHICH_CINEMA = 'Оберіть кінотеатр  або відправте ваше місцезнаходження щоб отримати інформацію тільки про найближчі кінотеатри'
+    WHICH_FILM = 'Напишіть назву фільму. Щоб спершу побачити найближчі кінотеатри, відправте ваше місцезнаходження'
+    FILM_NOT_FOUND = 'Фільм не знайдено серед фільмів в обраний час. Спробуйте іншу назву.'
     BOT_ERROR = 'Помилка роботи боту. Будь-ласка, спробуйте звернутися пізніше.'
     INPUT_ERROR = 'Помилка розпізнавання запиту. Спробуйте ще раз.'
+    SESSION_EXPIRED = 'Запит не знайдено або він застарів. Почнімо спочатку.'
+    API_UNAVAILABLE = 'Розклад кінотеатрів зараз недоступний. Спробуйте ще раз за хвилину.'
+    DATA_AS_OF = 'Дані станом на {}.\n'
+
+    # Telegram's limit of message length
+    MESSAGE_LIMIT = 4096
+
+    # {minutes since midnight: 'HH:MM'}
+    _TIME_LABELS = dict()
 
     @classmethod
-    def string_cinemas(cls, cinemas):
-        reply = ''
+    def string_cinemas(cls, cinemas, distances=None):
+        lines = []
         for index, cinema in enumerate(cinemas):
-            if cinema.distance:
-                reply += '/{} {} {}км'.format(index + 1, cinema.name, "{0:.2f}".format(cinema.distance)) + '\n'
+            if distances and cinema.id in distances:
+                lines.append('/{} {} {:.2f}км\n'.format(index + 1, cinema.name, distances[cinema.id]))
             else:
-                reply += '/{} {}'.format(index + 1, cinema.name) + '\n'
+                lines.append('/{} {}\n'.format(index + 1, cinema.name))
         
-        return reply
+        return ''.join(lines)
     
     @classmethod
     def string_shows(cls, shows):
-        reply = ''
-        for show in shows:
-            reply += '{} - {}'.format(show.time.strftime("%H:%M"), show.film_title)
-            reply += '\n'
+        return ''.join(['{} - {}\n'.format(cls._time_label(show.minute), show.film_title) for show in shows])
+
+    @classmethod
+    def string_film_shows(cls, film, film_shows, distances=None):
+        """
+        :param film_shows: list of (cinema, shows) as returned by Request.get_film_shows
+        """
+        lines = ['Фільм: {}\n'.format(film.title)]
+        for cinema, shows in film_shows:
+            times = ', '.join(cls._time_label(show.minute) for show in shows)
+            if distances and cinema.id in distances:
+                lines.append('{} {:.2f}км: {}\n'.format(cinema.name, distances[cinema.id], times))
+            else:
+                lines.append('{}: {}\n'.format(cinema.name, times))
+
+        return ''.join(lines)
+
+    @classmethod
+    def render_shows(cls, shows_in_city, cinema, times):
+        """
+        Shows of cinema between times rendered once and cached with shows_in_city (so for its date) for all users
+        :return: string_shows of the shows, empty if there are no shows
+        """
+        key = (cinema.id, times)
+        reply = shows_in_city.rendered.get(key)
+        if reply is None:
+            reply = shows_in_city.rendered[key] = cls.string_shows(shows_in_city.get_shows(cinema, times))
         return reply
 
+    @classmethod
+    def split_message(cls, text, limit=MESSAGE_LIMIT):
+        """
+        Splits text into messages not longer than limit, at line boundaries where possible
+        :return: list of messages
+        """
+        if len(text) <= limit:
+            return [text]
+
+        messages = []
+        start = 0
+        while len(text) - start > limit:
+            end = text.rfind('\n', start, start + limit) + 1
+            if end <= start:
+                # single line longer than limit
+                end = start + limit
+            messages.append(text[start:end])
+            start = end
+        messages.append(text[start:])
+        return messages
+
     @classmethod
     def string_request(cls, request):
         reply = ''
+        if len(CITIES) > 1:
+            reply += 'Місто: {}. '.format(CITIES.get(request.city))
         if request.date:
             reply += 'Дата: {}. '.format(request.date)
         if request.times:
@@ -35,3 +97,22 @@ class Phrases:
             reply += 'Кінотеатр: {}. '.format(request.cinema.name)
         reply += '\n'
         return reply
+
+    @classmethod
+    def string_data_as_of(cls, shows_in_city):
+        """
+        :return: note with time the schedule was fetched at if it could not be refreshed since, otherwise empty string
+        """
+        if not shows_in_city or not shows_in_city.stale:
+            return ''
+        fetched_at = datetime.fromtimestamp(shows_in_city.fetched_at)
+        if fetched_at.date() == datetime.now().date():
+            return cls.DATA_AS_OF.format(fetched_at.strftime('%H:%M'))
+        return cls.DATA_AS_OF.format(fetched_at.strftime('%d.%m %H:%M'))
+
+    @classmethod
+    def _time_label(cls, minute):
+        label = cls._TIME_LABELS.get(minute)
+        if label is None:
+            label = cls._TIME_LABELS[minute] = '{:02d}:{:02d}'.format(minute // 60, minute % 60)
+        return label
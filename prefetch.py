@@ -0,0 +1,67 @@
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from config import PREFETCH_DAYS, PREFETCH_INTERVALS, PREFETCH_RETRY_INTERVAL
+
+
+class Prefetcher(threading.Thread):
+    """
+    Background thread that keeps schedules of the dates offered to users (today and PREFETCH_DAYS - 1 next days)
+    fetched and indexed in the cache, so users never wait for API.
+    Date that is N days from today is refreshed every intervals[N] seconds (the last interval is used for the rest).
+    The window of dates moves forward at midnight
+    """
+    def __init__(self, cache, city=1, days=PREFETCH_DAYS, intervals=PREFETCH_INTERVALS):
+        super().__init__(name='prefetcher-{}'.format(city), daemon=True)
+        self.cache = cache
+        self.city = city
+        self.days = days
+        self.intervals = intervals
+
+        # {date: time.monotonic() of next refresh}
+        self._due = dict()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self._refresh_due()
+            self._stop_event.wait(self._seconds_to_sleep())
+
+    def stop(self):
+        self._stop_event.set()
+
+    def get_dates(self):
+        """
+        :return: offered dates in str('YYYY-MM-DD') as returned by Parser.parse_date, starting from today
+        """
+        today = datetime.today().date()
+        return [str(today + timedelta(days=days)) for days in range(self.days)]
+
+    def _refresh_due(self):
+        dates = self.get_dates()
+
+        # forgetting dates that are in the past after midnight
+        for date in set(self._due) - set(dates):
+            del self._due[date]
+
+        for days, date in enumerate(dates):
+            if self._stop_event.is_set():
+                return
+            if self._due.get(date, 0) > time.monotonic():
+                continue
+
+            interval = self.intervals[min(days, len(self.intervals) - 1)]
+            try:
+                # cached schedule should live until next refresh
+                self.cache.refresh(self.city, date, ttl=interval + PREFETCH_RETRY_INTERVAL)
+            except Exception:
+                logging.warning("prefetch of city '{}' date '{}' failed".format(self.city, date))
+                interval = min(interval, PREFETCH_RETRY_INTERVAL)
+            self._due[date] = time.monotonic() + interval
+
+    def _seconds_to_sleep(self):
+        now = datetime.now()
+        until_midnight = (datetime.combine(now.date() + timedelta(days=1), datetime.min.time()) - now).total_seconds()
+        until_due = min(self._due.values(), default=0) - time.monotonic()
+        return max(min(until_due, until_midnight), 1)
@@ -0,0 +1,105 @@
+import functools
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from config import PROFILE_RATE, PROFILE_INTERVAL, PROFILE_DIR
+
+
+class SamplingProfiler:
+    """
+    Samples stacks of a fraction (rate) of handler invocations every interval seconds from a background thread.
+    Stacks are aggregated per handler with the state of user's request and dumped in collapsed-stack format
+    ('frame;frame;frame count' lines) that flamegraph.pl / speedscope read
+    """
+    def __init__(self, rate=PROFILE_RATE, interval=PROFILE_INTERVAL, directory=PROFILE_DIR):
+        self.rate = rate
+        self.interval = interval
+        self.directory = directory
+
+        # {thread id: (handler name, request description, frame of the handler)}
+        self._active = dict()
+        # {handler name: Counter({collapsed stack: samples})}
+        self._stacks = dict()
+        self._lock = threading.Lock()
+        self._sampler = None
+
+    def profile(self, name, describe=None):
+        """
+        Decorator that samples rate of calls of decorated handler
+        :param describe: function of handler's arguments returning description of user's request
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.rate or random.random() >= self.rate:
+                    return function(*args, **kwargs)
+
+                description = describe(*args, **kwargs) if describe else ''
+                thread_id = threading.get_ident()
+                self._start_sampler()
+                with self._lock:
+                    self._active[thread_id] = (name, description, sys._getframe())
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    with self._lock:
+                        self._active.pop(thread_id, None)
+            return wrapper
+        return decorator
+
+    def dump(self):
+        """
+        Writes collected stacks to PROFILE_DIR/<handler>.<time>.folded and starts collecting from scratch
+        :return: paths of written files
+        """
+        with self._lock:
+            stacks, self._stacks = self._stacks, dict()
+
+        os.makedirs(self.directory, exist_ok=True)
+        paths = []
+        for name, counter in stacks.items():
+            path = os.path.join(self.directory, '{}.{}.folded'.format(name, time.strftime('%Y%m%d-%H%M%S')))
+            with open(path, 'w') as output:
+                for stack, samples in counter.most_common():
+                    output.write('{} {}\n'.format(stack, samples))
+            paths.append(path)
+        return paths
+
+    def _start_sampler(self):
+        if self._sampler is None:
+            with self._lock:
+                if self._sampler is None:
+                    self._sampler = threading.Thread(target=self._sample, name='profiler', daemon=True)
+                    self._sampler.start()
+
+    def _sample(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._active:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, (name, description, top) in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        stack = self._collapse(frame, top)
+                        self._stacks.setdefault(name, Counter())[';'.join(filter(None, (name, description, stack)))] += 1
+
+    @staticmethod
+    def _collapse(frame, top):
+        """
+        :return: 'file:function;...' from the handler (top) down to the sampled frame
+        """
+        frames = []
+        while frame is not None and frame is not top:
+            code = frame.f_code
+            frames.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        return ';'.join(reversed(frames))
+
+
+PROFILER = SamplingProfiler()
+
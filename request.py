@@ -1,7 +1,9 @@
 from datetime import datetime
-from api import ShowsInCity, APIError
+from api import SHOWS_CACHE, APIError
+from config import CITIES
 from parser import Parser
 from locator import Locator
+from phrases import Phrases
 import logging
 
 class RequestError(Exception):
@@ -12,29 +14,38 @@ class Request:
     """
     High-level object created for each communication with user. To be used for data extraction for user.
     """
-    def __init__(self, state):
+    def __init__(self, state, city=None):
         # added during init
         self.state = state
 
-        # provided by user
+        # provided by user (the first offered city if there is only one)
+        self.city = city or next(iter(CITIES))
         self.date = str(datetime.now().date())
         self.times = tuple([datetime.now().strftime('%H'), 23])
         
         # will be initialized after date and time are provided by user
+        # shared with other requests via SHOWS_CACHE - read-only
         self.shows_in_city = None
         
         # chosen by user after options are provided to him
         self.cinema = None
+        # found by title in film search
+        self.film = None
+        # (latitude, longitude) shared by user
+        self.location = None
 
         # will be calculated
         self.cinemas = []
         self.mapped_cinemas = {}
+        # {cinema_id: distance in km} for cinemas found by location
+        self.distances = {}
 
     def get_cinemas(self):
         if not self.shows_in_city:
             self._init_sic()
 
         self.cinemas = self.shows_in_city.get_cinemas_with_shows(self.times)
+        self.distances = {}
         self._map_cinemas()
 
         if not self.cinemas:
@@ -49,12 +60,16 @@ class Request:
         """
         if not self.shows_in_city:
             self._init_sic()
-        
+
+        self.location = (latitude, longitude)
         if not self.cinemas:
             self.cinemas = self.shows_in_city.get_cinemas_with_shows(self.times)
 
         # overwriting all cinemas to only closest to proper map them
-        self.cinemas = Locator.get_verified_closest(latitude, longitude, self.cinemas)
+        closest = Locator.get_verified_closest(latitude, longitude, self.cinemas,
+                                               points=self.shows_in_city.cinema_points)
+        self.cinemas = [cinema for cinema, distance in closest]
+        self.distances = {cinema.id: distance for cinema, distance in closest}
         self._map_cinemas()
 
         return self.cinemas
@@ -69,25 +84,78 @@ class Request:
         if not shows:
             raise RequestError
 
-        shows.sort(key=lambda x: x.time)
-
         return shows
 
+    def get_shows_reply(self):
+        """
+        Returns rendered shows of chosen cinema. Rendering is cached with shows_in_city for all users
+        """
+        if not self.shows_in_city:
+            self._init_sic()
+
+        reply = Phrases.render_shows(self.shows_in_city, self.cinema, self.times)
+
+        if not reply:
+            raise RequestError
+
+        return reply
+
+    def get_film_shows(self):
+        """
+        Returns list of (cinema, shows) of chosen film in all cinemas, the closest cinemas first if location is shared
+        """
+        if not self.shows_in_city:
+            self._init_sic()
+
+        film_shows = self.shows_in_city.get_film_shows(self.film, self.times)
+        self.distances = {}
+
+        if not film_shows:
+            raise RequestError
+
+        if self.location:
+            closest = Locator.get_verified_closest(self.location[0], self.location[1], [cinema for cinema, _ in film_shows],
+                                                   result_amount=len(film_shows), points=self.shows_in_city.cinema_points)
+            self.distances = {cinema.id: distance for cinema, distance in closest}
+            film_shows.sort(key=lambda item: self.distances[item[0].id])
+
+        return film_shows
+
     def set_chat_id(self, chat_id):
         self.chat_id = chat_id
 
     def set_cinema_from_message(self, message):
         try:
-            self.cinema = Parser.parse_cinema(message, self.cinemas, self.mapped_cinemas)
+            index = self.shows_in_city.cinema_index if self.shows_in_city else None
+            self.cinema = Parser.parse_cinema(message, self.cinemas, self.mapped_cinemas, index)
         except Exception:
             raise
     
+    def set_film_from_message(self, message):
+        """
+        Finds film by title among films with shows at chosen time
+        """
+        if not self.shows_in_city:
+            self._init_sic()
+
+        self.film = Parser.parse_film(message, self.shows_in_city.films, self.shows_in_city.film_index,
+                                      self.shows_in_city.get_films_with_shows(self.times))
+
+    def set_location(self, latitude, longitude):
+        self.location = (latitude, longitude)
+
     def set_times_from_cb_data(self, cbdata):
         try:
             self.times = Parser.parse_time(cbdata)
         except Exception:
             raise
 
+    def set_city_from_cb_data(self, cbdata):
+        self.city = Parser.parse_city(cbdata, CITIES)
+        # schedule of another city could be loaded already
+        self.shows_in_city = None
+        self.film = None
+
     def set_date_from_cb_data(self, cbdata):
         try:
             self.date = Parser.parse_date(cbdata)
@@ -101,6 +169,17 @@ class Request:
 
         return ('з {} до {}'.format(time_min, time_max))
 
+    def release(self):
+        """
+        Drops references to shows and cinemas when request is removed from session store
+        """
+        self.shows_in_city = None
+        self.cinema = None
+        self.film = None
+        self.cinemas = []
+        self.mapped_cinemas = {}
+        self.distances = {}
+
     def _map_cinemas(self):
         self.mapped_cinemas = dict()
         for index, cinema in enumerate(self.cinemas):
@@ -111,6 +190,6 @@ class Request:
             logging.warning('trying to init request.shows_in_city without request.date set')
             raise RequestError
         try:
-            self.shows_in_city = ShowsInCity(1, self.date)
+            self.shows_in_city = SHOWS_CACHE.get(self.city, self.date)
         except Exception:
             raise
\ No newline at end of file
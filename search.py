@@ -0,0 +1,88 @@
+import re
+from collections import Counter
+
+# Ukrainian (and a few Russian) letters to Latin, so 'Планета Кіно' and 'planeta kino' are the same
+TRANSLITERATION = str.maketrans({'а': 'a', 'б': 'b', 'в': 'v', 'г': 'h', 'ґ': 'g', 'д': 'd', 'е': 'e', 'є': 'ie',
+                                 'ж': 'zh', 'з': 'z', 'и': 'y', 'і': 'i', 'ї': 'i', 'й': 'i', 'к': 'k', 'л': 'l',
+                                 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u',
+                                 'ф': 'f', 'х': 'kh', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'shch', 'ь': '',
+                                 'ю': 'iu', 'я': 'ia', 'ы': 'y', 'э': 'e', 'ё': 'e', 'ъ': ''})
+
+# letters that are spelled differently in Latin names and their transliterations ('Multiplex' - 'Мультиплекс')
+SIMILAR_SPELLINGS = (('kh', 'h'), ('x', 'ks'), ('y', 'i'), ('h', 'g'), ('w', 'v'), ('q', 'k'), ('ck', 'k'))
+
+APOSTROPHES = re.compile(r"['’ʼ`‘\"]")
+NOT_ALPHANUMERIC = re.compile(r'[^0-9a-z]+')
+
+
+def normalize(text):
+    """
+    Case-folds, drops apostrophes, transliterates to Latin and unifies similar spellings
+    :return: words separated by single spaces
+    """
+    text = APOSTROPHES.sub('', text.casefold()).translate(TRANSLITERATION)
+    for spelling, replacement in SIMILAR_SPELLINGS:
+        text = text.replace(spelling, replacement)
+    return NOT_ALPHANUMERIC.sub(' ', text).strip()
+
+
+def trigrams(text):
+    padded = '  {} '.format(text)
+    return {padded[index:index + 3] for index in range(len(padded) - 2)}
+
+
+class NameIndex:
+    """
+    Trigram index of normalized names. Search touches only names that share trigrams with the query,
+    ranks them by trigram similarity and tolerates typos and Latin/Cyrillic mixing
+    """
+    # minimal score of returned match
+    MIN_SCORE = 0.3
+
+    def __init__(self, items):
+        """
+        :param items: iterable of (key, name), e.g. (cinema id, cinema name)
+        """
+        self.keys = list()
+        self.names = list()
+        # {trigram: [positions of names containing it]}
+        self.postings = dict()
+
+        for key, name in items:
+            position = len(self.keys)
+            normalized = normalize(name)
+            self.keys.append(key)
+            self.names.append(normalized)
+            for trigram in trigrams(normalized):
+                self.postings.setdefault(trigram, []).append(position)
+
+        self._sizes = [len(trigrams(name)) for name in self.names]
+
+    def search(self, query, candidates=None, limit=5):
+        """
+        :param candidates: set of keys to search among (all if None)
+        :return: list of (key, score) sorted from the best match
+        """
+        query = normalize(query)
+        if not query:
+            return []
+        query_trigrams = trigrams(query)
+
+        shared = Counter()
+        for trigram in query_trigrams:
+            shared.update(self.postings.get(trigram, ()))
+
+        matches = []
+        for position, count in shared.items():
+            key = self.keys[position]
+            if candidates is not None and key not in candidates:
+                continue
+            # Dice coefficient, whole query inside the name is the best match
+            score = 2 * count / (len(query_trigrams) + self._sizes[position])
+            if query in self.names[position]:
+                score += 1
+            if score >= self.MIN_SCORE:
+                matches.append((key, score))
+
+        matches.sort(key=lambda match: -match[1])
+        return matches[:limit]
@@ -0,0 +1,91 @@
+import threading
+import time
+from collections import OrderedDict
+from config import SESSIONS_MAX_SIZE, SESSION_TTL
+
+
+class SessionStore:
+    """
+    Bounded store of user requests by chat id.
+    Sessions idle for more than ttl seconds expire, least recently used ones are evicted when max_size is reached.
+    Heavy data of removed sessions is released
+    """
+    def __init__(self, factory, max_size=SESSIONS_MAX_SIZE, ttl=SESSION_TTL):
+        self.factory = factory
+        self.max_size = max_size
+        self.ttl = ttl
+        self.evictions = 0
+        self.expirations = 0
+
+        # {chat_id: (last_used, request)} ordered from least to most recently used
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, chat_id):
+        """
+        Returns request of the chat or None if there is no session (never started, evicted or expired)
+        """
+        with self._lock:
+            session = self._sessions.get(chat_id)
+            if session is None:
+                return None
+
+            now = time.monotonic()
+            if now - session[0] > self.ttl:
+                del self._sessions[chat_id]
+                self.expirations += 1
+                session[1].release()
+                return None
+
+            self._sessions[chat_id] = (now, session[1])
+            self._sessions.move_to_end(chat_id)
+            return session[1]
+
+    def create(self, chat_id):
+        """
+        Starts new session for the chat, replacing existing one
+        """
+        request = self.factory()
+        with self._lock:
+            self._expire()
+            old = self._sessions.pop(chat_id, None)
+            if old:
+                old[1].release()
+
+            while len(self._sessions) >= self.max_size:
+                _, (_, evicted) = self._sessions.popitem(last=False)
+                self.evictions += 1
+                evicted.release()
+
+            self._sessions[chat_id] = (time.monotonic(), request)
+        return request
+
+    def pop(self, chat_id, default=None):
+        with self._lock:
+            session = self._sessions.pop(chat_id, None)
+        if session is None:
+            return default
+        session[1].release()
+        return session[1]
+
+    def stats(self):
+        return {'sessions': len(self._sessions),
+                'max_size': self.max_size,
+                'evictions': self.evictions,
+                'expirations': self.expirations}
+
+    def _expire(self):
+        """
+        Removes idle sessions. They are the least recently used, so only the beginning of the store is checked
+        """
+        now = time.monotonic()
+        while self._sessions:
+            chat_id, (last_used, request) = next(iter(self._sessions.items()))
+            if now - last_used <= self.ttl:
+                break
+            del self._sessions[chat_id]
+            self.expirations += 1
+            request.release()
@@ -0,0 +1,194 @@
+import json
+import logging
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from entities import Cinema, Hall, Film, ShowTable
+from config import SNAPSHOT_MAX_AGE
+
+# length of JSON header in front of show tables columns
+_HEADER = struct.Struct('<I')
+
+
+def dump_schedule(schedule):
+    """
+    Serializes ShowsInCity into bytes: length of JSON header, JSON header with cinemas, halls, films and
+    sizes of show tables, then raw array columns of every show table
+    """
+    tables = list(schedule.show_tables.items())
+    header = json.dumps({'cinemas': [[c.id, c.name, c.latitude, c.longitude] for c in schedule.cinemas.values()],
+                         'halls': [[h.id, h.cinema_id] for h in schedule.halls.values()],
+                         'films': [[f.id, f.title] for f in schedule.films.values()],
+                         'tables': [[cinema_id, len(table)] for cinema_id, table in tables],
+                         'validators': getattr(schedule, 'validators', None)},
+                        ensure_ascii=False).encode('utf-8')
+
+    chunks = [_HEADER.pack(len(header)), header]
+    for _, table in tables:
+        for column in ShowTable.COLUMNS:
+            chunks.append(getattr(table, column).tobytes())
+    return b''.join(chunks)
+
+
+def load_schedule(data, copy=True):
+    """
+    Reverse of dump_schedule
+    :param copy: copy show tables into arrays. Otherwise columns are memoryviews of data, which must stay unchanged
+    :return: dict of cinemas, halls, films, show_tables and validators as used by ShowsInCity
+    """
+    data = memoryview(data)
+    header_size, = _HEADER.unpack_from(data)
+    offset = _HEADER.size + header_size
+    header = json.loads(bytes(data[_HEADER.size:offset]).decode('utf-8'))
+
+    show_tables = dict()
+    for cinema_id, rows in header['tables']:
+        if copy:
+            table = show_tables[cinema_id] = ShowTable()
+            for column in ShowTable.COLUMNS:
+                array = getattr(table, column)
+                size = rows * array.itemsize
+                array.frombytes(data[offset:offset + size])
+                offset += size
+        else:
+            columns = []
+            for typecode in ShowTable.TYPECODES:
+                size = rows * struct.calcsize(typecode)
+                columns.append(data[offset:offset + size].cast(typecode))
+                offset += size
+            show_tables[cinema_id] = ShowTable.from_columns(columns)
+
+    return {'cinemas': {item[0]: Cinema(*item) for item in header['cinemas']},
+            'halls': {item[0]: Hall(*item) for item in header['halls']},
+            'films': {item[0]: Film(*item) for item in header['films']},
+            'show_tables': show_tables,
+            'validators': header.get('validators')}
+
+
+class SnapshotStore:
+    """
+    SQLite file with serialized schedules by (city, date) and time they were fetched at.
+    Nothing is read up front - a schedule is loaded only when it is requested
+    """
+    def __init__(self, path, max_age=SNAPSHOT_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self._lock = threading.Lock()
+
+        with self._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS snapshots ('
+                               'city INTEGER, date TEXT, fetched_at REAL, data BLOB, PRIMARY KEY (city, date))')
+
+    def save(self, schedule):
+        """
+        Stores ShowsInCity and drops snapshots older than max_age
+        """
+        data = dump_schedule(schedule)
+        try:
+            with self._lock, self._connect() as connection:
+                connection.execute('INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?)',
+                                   (schedule.city, schedule.date, schedule.fetched_at, data))
+                connection.execute('DELETE FROM snapshots WHERE fetched_at < ?', (time.time() - self.max_age,))
+        except sqlite3.Error:
+            logging.warning("snapshot of city '{}' date '{}' was not saved".format(schedule.city, schedule.date))
+
+    def touch(self, schedule):
+        """
+        Updates fetched_at of stored schedule that has not changed since it was saved
+        """
+        try:
+            with self._lock, self._connect() as connection:
+                connection.execute('UPDATE snapshots SET fetched_at = ? WHERE city = ? AND date = ?',
+                                   (schedule.fetched_at, schedule.city, schedule.date))
+        except sqlite3.Error:
+            logging.warning("snapshot of city '{}' date '{}' was not touched".format(schedule.city, schedule.date))
+
+    def load(self, city, date):
+        """
+        :return: (fetched_at, dict of schedule parts) or None if there is no snapshot younger than max_age
+        """
+        try:
+            with self._lock, self._connect() as connection:
+                row = connection.execute('SELECT fetched_at, data FROM snapshots WHERE city = ? AND date = ? AND fetched_at >= ?',
+                                         (city, date, time.time() - self.max_age)).fetchone()
+        except sqlite3.Error:
+            logging.warning("snapshot of city '{}' date '{}' was not loaded".format(city, date))
+            return None
+
+        if row is None:
+            return None
+        return row[0], load_schedule(row[1])
+
+    @contextmanager
+    def _connect(self):
+        """
+        Connection that commits on success and is always closed
+        """
+        connection = sqlite3.connect(self.path)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+
+class SharedScheduleStore:
+    """
+    Directory of schedules in dump_schedule format shared by processes of one host (ideally on tmpfs).
+    One process fetches and saves schedules, others map the files read-only, so show tables are neither parsed
+    nor copied in every process and memory pages are shared. Interface is the same as of SnapshotStore
+    """
+    def __init__(self, directory, max_age=SNAPSHOT_MAX_AGE):
+        self.directory = directory
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+
+    def save(self, schedule):
+        """
+        Replaces file of the schedule atomically, so readers see either old or new one. Modification time is fetched_at
+        """
+        path = self._path(schedule.city, schedule.date)
+        temporary = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(temporary, 'wb') as output:
+                output.write(dump_schedule(schedule))
+            os.utime(temporary, (schedule.fetched_at, schedule.fetched_at))
+            os.replace(temporary, path)
+        except OSError:
+            logging.warning("shared schedule of city '{}' date '{}' was not saved".format(schedule.city, schedule.date))
+
+    def touch(self, schedule):
+        """
+        Sets modification time of the file of schedule that has not changed since it was saved to its fetched_at
+        """
+        try:
+            os.utime(self._path(schedule.city, schedule.date), (schedule.fetched_at, schedule.fetched_at))
+        except OSError:
+            logging.warning("shared schedule of city '{}' date '{}' was not touched".format(schedule.city, schedule.date))
+
+    def load(self, city, date):
+        """
+        :return: (fetched_at, dict of schedule parts with show tables mapped from file) or None if there is no
+        schedule younger than max_age
+        """
+        try:
+            with open(self._path(city, date), 'rb') as schedule_file:
+                fetched_at = os.fstat(schedule_file.fileno()).st_mtime
+                if fetched_at < time.time() - self.max_age:
+                    return None
+                # mapping stays valid after the file is closed or replaced and is unmapped when tables are collected
+                data = mmap.mmap(schedule_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            logging.warning("shared schedule of city '{}' date '{}' was not loaded".format(city, date))
+            return None
+
+        return fetched_at, load_schedule(data, copy=False)
+
+    def _path(self, city, date):
+        return os.path.join(self.directory, '{}-{}.schedule'.format(city, date))
@@ -0,0 +1,150 @@
+"""
+Tests of streamed parsing of API responses and of incremental schedule updates
+
+    python3 -m unittest test_schedules
+"""
+import copy
+import json
+import unittest
+from api import ShowsInCity, ScheduleBuilder
+from bench import synthesize_payload, DATE, WINDOWS
+from jsonstream import iter_members
+from phrases import Phrases
+
+
+def expected_members(body, arrays):
+    """
+    :return: list of (name, value) iter_members should yield for body, decoded with json.loads
+    """
+    members = []
+    for name, value in json.loads(body.decode('utf-8')).items():
+        if name in arrays and isinstance(value, list):
+            members.extend((name, element) for element in value)
+        else:
+            members.append((name, value))
+    return members
+
+
+class IterMembersTest(unittest.TestCase):
+    BODIES = [b'{}',
+              b' { } ',
+              b'{"n": 12345, "f": -0.25e-3, "t": true, "x": null, "e": [], "o": {}}',
+              '{"name": "Київ \\"Жовтень\\" \\u0457", "items": [1, [2, [3]], {"a": "ї"}], "n": 7}'.encode('utf-8'),
+              b'{"content": [], "films": [{"id": 1}], "halls": [10 , 20 ,30], "cinemas": "not an array"}',
+              json.dumps(synthesize_payload(cinemas=2, halls_per_cinema=1, films=3, items=4),
+                         ensure_ascii=False).encode('utf-8')]
+    ARRAYS = ScheduleBuilder.COLLECTIONS + ('items', 'e')
+
+    def test_split_at_every_offset(self):
+        for body in self.BODIES:
+            for arrays in ((), self.ARRAYS):
+                expected = expected_members(body, arrays)
+                for offset in range(len(body) + 1):
+                    chunks = [body[:offset], body[offset:]]
+                    self.assertEqual(list(iter_members(chunks, arrays)), expected, (body, offset))
+
+    def test_single_byte_chunks(self):
+        for body in self.BODIES:
+            chunks = [body[offset:offset + 1] for offset in range(len(body))]
+            self.assertEqual(list(iter_members(chunks, self.ARRAYS)), expected_members(body, self.ARRAYS))
+
+    def test_truncated_body(self):
+        for body in self.BODIES:
+            body = body.strip()
+            for offset in range(len(body)):
+                with self.assertRaises(ValueError, msg=(body, offset)):
+                    list(iter_members([body[:offset]], self.ARRAYS))
+
+
+def describe(shows_in_city):
+    """
+    :return: results of all queries handlers make to the schedule, in comparable form
+    """
+    result = []
+    for times in WINDOWS:
+        cinemas = shows_in_city.get_cinemas_with_shows(times)
+        result.append([(cinema.id, cinema.name) for cinema in cinemas])
+        for cinema_id in sorted(shows_in_city.cinemas):
+            cinema = shows_in_city.cinemas[cinema_id]
+            result.append([(show.id, show.minute, show.film_title, show.cinema_name)
+                           for show in shows_in_city.get_shows(cinema, times)])
+            result.append(Phrases.render_shows(shows_in_city, cinema, times))
+        result.append(sorted(shows_in_city.get_films_with_shows(times)))
+        for film_id in sorted(shows_in_city.films):
+            film_shows = shows_in_city.get_film_shows(shows_in_city.films[film_id], times)
+            result.append([(cinema.id, [(show.id, show.minute, show.film_title) for show in shows])
+                           for cinema, shows in film_shows])
+    return result
+
+
+def build(payload):
+    shows_in_city = ShowsInCity(1, DATE, copy.deepcopy(payload))
+    shows_in_city.materialize(WINDOWS)
+    return shows_in_city
+
+
+class UpdateTest(unittest.TestCase):
+    def setUp(self):
+        self.payload = synthesize_payload(cinemas=6, halls_per_cinema=2, films=8, items=60, seed=1)
+
+    def add_show(self, payload):
+        item = dict(payload['content'][0], id=10000, times=[{'time': '21:05:00'}])
+        payload['content'].append(item)
+
+    def remove_shows(self, payload):
+        del payload['content'][1:6]
+
+    def retime_show(self, payload):
+        payload['content'][7]['times'] = [{'time': '09:15:00'}, {'time': '23:55:00'}]
+
+    def rename_film(self, payload):
+        payload['films'][0]['title'] = 'Перейменований фільм'
+
+    def rename_cinema(self, payload):
+        payload['cinemas'][1]['name'] = 'Аврора'
+
+    def remove_cinema(self, payload):
+        cinema_id = payload['cinemas'][2]['id']
+        hall_ids = {hall['id'] for hall in payload['halls'] if hall['cinema_id'] == cinema_id}
+        payload['cinemas'] = [cinema for cinema in payload['cinemas'] if cinema['id'] != cinema_id]
+        payload['halls'] = [hall for hall in payload['halls'] if hall['id'] not in hall_ids]
+        payload['content'] = [item for item in payload['content'] if item['hall_id'] not in hall_ids]
+
+    def assert_updated(self, old, payload):
+        before = describe(old)
+        updated, _ = old.update(ShowsInCity(1, DATE, copy.deepcopy(payload)))
+        self.assertEqual(describe(updated), describe(build(payload)))
+        # requests may still be reading the old schedule
+        self.assertEqual(describe(old), before)
+        return updated
+
+    def test_every_change(self):
+        changes = [self.add_show, self.remove_shows, self.retime_show, self.rename_film, self.rename_cinema,
+                   self.remove_cinema]
+        for change in changes:
+            payload = copy.deepcopy(self.payload)
+            change(payload)
+            with self.subTest(change=change.__name__):
+                old = build(self.payload)
+                # indexes, film tables and rendered replies are reused by update, so have them built
+                describe(old)
+                self.assert_updated(old, payload)
+
+    def test_successive_changes(self):
+        shows_in_city = build(self.payload)
+        payload = copy.deepcopy(self.payload)
+        for change in (self.rename_film, self.add_show, self.retime_show, self.remove_shows, self.remove_cinema):
+            change(payload)
+            describe(shows_in_city)
+            shows_in_city = self.assert_updated(shows_in_city, payload)
+
+    def test_unchanged(self):
+        old = build(self.payload)
+        describe(old)
+        updated, affected = old.update(ShowsInCity(1, DATE, copy.deepcopy(self.payload)))
+        self.assertEqual(affected, set())
+        self.assertEqual(describe(updated), describe(old))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+import importlib
+import logging
+import multiprocessing
+import os
+import threading
+from multiprocessing.connection import wait
+from api import APIError
+from dispatcher import ChatDispatcher, get_chat_id
+from metrics import start_metrics_server
+from config import (WORKER_PROCESSES, DISPATCH_MAX_IN_FLIGHT, SHARED_STORE_CHECK_INTERVAL, SHOWS_CACHE_TTL,
+                    CITY_PREFETCH_INTERVALS, PREFETCH_RETRY_INTERVAL, LOG_LEVEL, LOG_FORMAT, WORKER_FETCH_TIMEOUT,
+                    METRICS_PORT)
+
+
+class WorkerPool:
+    """
+    Runs bot handlers in worker processes, so they are not bound by one GIL.
+    Updates are routed by chat id: chat is always served by the same worker, which keeps its session
+    and processes its updates in order (with ChatDispatcher). Has the same dispatch() as ChatDispatcher.
+    Schedules are fetched by the main process only and shared with workers through SharedScheduleStore.
+    Worker that misses a schedule in the store asks main process to fetch it over its pipe and waits for the file.
+    Workers (restarted ones too) are forked from a fork server that imported app once, so they never inherit threads,
+    held locks or cached schedules of the main process.
+    Worker i serves its own metrics (handlers, sessions, outbox) on METRICS_PORT + 1 + i
+    """
+    def __init__(self, app, cache, store, processes=WORKER_PROCESSES, max_in_flight=DISPATCH_MAX_IN_FLIGHT):
+        """
+        :param app: name of module that creates bot and SHOWS_CACHE and registers handlers when imported
+        (main.py passes its __name__)
+        :param cache: CityShowsCache of the main process
+        :param store: SharedScheduleStore main process saves fetched schedules to and workers map them from
+        """
+        self.app = app
+        self.cache = cache
+        self.store = store
+        self.queue_size = max(max_in_flight // processes, 1)
+        # updates waiting for every worker, put() blocks when a worker falls behind
+        self.queues = [None] * processes
+        # main process ends of pipes workers request fetches over
+        self.connections = [None] * processes
+        self.processes = [None] * processes
+        self._send_lock = threading.Lock()
+
+        self.context = multiprocessing.get_context('forkserver')
+        self.context.set_forkserver_preload([app])
+
+    def start(self):
+        self.cache.use_shared_store(self.store, readonly=False)
+        for index in range(len(self.processes)):
+            self._start_worker(index)
+        threading.Thread(target=self._answer_fetches, name='worker-fetches', daemon=True).start()
+
+    def dispatch(self, update):
+        index = (get_chat_id(update) or 0) % len(self.queues)
+        if not self.processes[index].is_alive():
+            logging.warning("worker '{}' exited with code '{}', restarting".format(index, self.processes[index].exitcode))
+            self._start_worker(index)
+        self.queues[index].put(update)
+
+    def _start_worker(self, index):
+        # queue of a killed worker can be left locked, updates in it are lost anyway
+        self.queues[index] = self.context.Queue(self.queue_size)
+        connection, worker_connection = self.context.Pipe()
+        metrics_port = METRICS_PORT + 1 + index if METRICS_PORT else 0
+        process = self.context.Process(target=_serve,
+                                       args=(self.app, self.store, self.queues[index], worker_connection, metrics_port),
+                                       name='worker-{}'.format(index), daemon=True)
+        process.start()
+        # pipe is closed when the worker exits
+        worker_connection.close()
+        self.connections[index] = connection
+        self.processes[index] = process
+
+    def _answer_fetches(self):
+        """
+        Main process: receives (city, date) fetch requests of workers and fetches every one in its own thread
+        """
+        while True:
+            connections = [connection for connection in self.connections if connection is not None]
+            for connection in wait(connections, timeout=1):
+                try:
+                    city, date = connection.recv()
+                except (EOFError, OSError):
+                    # worker exited, the pipe of its replacement is already in self.connections
+                    self.connections = [None if item is connection else item for item in self.connections]
+                    connection.close()
+                    continue
+                threading.Thread(target=self._fetch, args=(connection, city, date), daemon=True).start()
+
+    def _fetch(self, connection, city, date):
+        """
+        Gets schedule through the cache of main process, which saves it to shared store, and replies with error or None
+        """
+        try:
+            self.cache.get(city, date)
+            error = None
+        except Exception as e:
+            logging.warning("fetch of city '{}' date '{}' for worker failed: {!r}".format(city, date, e))
+            error = repr(e)
+        with self._send_lock:
+            try:
+                connection.send((city, date, error))
+            except OSError:
+                pass
+
+
+class _Fetcher:
+    """
+    Worker process side of fetch requests: ShowsCache fetcher that asks main process to fetch a schedule and waits for it
+    """
+    def __init__(self, connection, timeout=WORKER_FETCH_TIMEOUT):
+        self.connection = connection
+        self.timeout = timeout
+
+        # {(city, date): [threading.Event set on reply, error]}
+        self._waiting = dict()
+        self._lock = threading.Lock()
+        self._reader = None
+
+    def __call__(self, city, date):
+        """
+        Raises APIError if main process failed to fetch the schedule or did not reply in time
+        """
+        key = (city, date)
+        with self._lock:
+            if self._reader is None:
+                self._reader = threading.Thread(target=self._read_replies, name='fetch-replies', daemon=True)
+                self._reader.start()
+            waiting = self._waiting.get(key)
+            if waiting is None:
+                waiting = self._waiting[key] = [threading.Event(), None]
+                self.connection.send(key)
+
+        if not waiting[0].wait(self.timeout):
+            with self._lock:
+                # the next call requests the fetch again
+                if self._waiting.get(key) is waiting:
+                    del self._waiting[key]
+            raise APIError("main process did not fetch city '{}' date '{}' in time".format(city, date))
+        if waiting[1]:
+            raise APIError(waiting[1])
+
+    def _read_replies(self):
+        while True:
+            city, date, error = self.connection.recv()
+            with self._lock:
+                waiting = self._waiting.pop((city, date), None)
+            if waiting:
+                waiting[1] = error
+                waiting[0].set()
+
+
+def _serve(app, store, queue, connection, metrics_port=0):
+    """
+    Worker process: reads schedules from shared store and hands received updates to its own ChatDispatcher
+    :param connection: pipe to main process to request fetches of schedules over
+    :param metrics_port: port of metrics endpoint of the worker (0 to disable)
+    """
+    logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
+    app = importlib.import_module(app)
+    # schedules are refreshed by main process at least every SHOWS_CACHE_TTL or prefetch interval
+    stale_after = max([SHOWS_CACHE_TTL] + [max(intervals) + PREFETCH_RETRY_INTERVAL
+                                           for intervals in CITY_PREFETCH_INTERVALS.values()])
+    app.SHOWS_CACHE.use_shared_store(store, readonly=True, ttl=SHARED_STORE_CHECK_INTERVAL, stale_after=stale_after,
+                                     fetcher=_Fetcher(connection))
+    if metrics_port:
+        start_metrics_server(metrics_port)
+    dispatcher = ChatDispatcher(app.bot)
+    logging.info("worker '{}' started".format(os.getpid()))
+    while True:
+        dispatcher.dispatch(queue.get())